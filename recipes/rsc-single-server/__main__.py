@@ -4,6 +4,7 @@ import os
 from pathlib import Path
 from textwrap import dedent
 from typing import Dict, Optional, List
+import hashlib
 import json
 import subprocess
 
@@ -21,6 +22,12 @@ def get_private_key(file_path: str) -> str:
     return private_key
 
 
+def content_hash(content: str, **variables) -> str:
+    """Trigger value for a script and the variables it was rendered from"""
+    payload = json.dumps(variables, sort_keys=True, default=str) + "\n" + content
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
 def make_rsc_server(
     tags: Dict, 
     key_pair: ec2.KeyPair, 
@@ -122,6 +129,7 @@ def main():
         local_path="templates/justfile", 
         remote_path='justfile', 
         connection=connection, 
+        triggers=[content_hash(Path("templates/justfile").read_text())],
         opts=pulumi.ResourceOptions(depends_on=[rsc_server])
     )
     
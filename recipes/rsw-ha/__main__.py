@@ -4,12 +4,17 @@
 import os
 from pathlib import Path
 from textwrap import dedent
-from typing import Dict, Optional, List
+from typing import Dict, Optional, List, Tuple
+import base64
+import gzip
+import hashlib
 import json
+import re
+import shlex
 import subprocess
 
 import pulumi
-from pulumi_aws import ec2, efs, rds, ssm, iam
+from pulumi_aws import autoscaling, ec2, efs, lb, rds, ssm, iam
 from pulumi_command import remote
 
 
@@ -20,6 +25,46 @@ EMAIL = config.require("email")
 AWS_PRIVATE_KEY_PATH = config.require("aws_private_key_path")
 AWS_SSH_KEY_ID = config.require_secret("aws_ssh_key_id")
 RSW_LICENSE = config.require_secret("rsw_license")
+NODE_COUNT = config.get_int("node_count") or 2  # Number of Workbench nodes in the cluster.
+SUBNET_IDS = config.get_object("subnet_ids") or []  # Subnets of the default VPC to spread the nodes over, one per availability zone.
+TIMELINE = config.get_bool("timeline") or False  # Record per-step timings on each server.
+APT_CACHE = config.get_bool("apt_cache") or False  # Share an apt-cacher-ng proxy between the servers.
+APT_CACHE_PORT = 3142
+
+# EFS holds the home directories and the shared storage, see
+# https://docs.aws.amazon.com/efs/latest/ug/performance.html for the modes.
+EFS_THROUGHPUT_MODE = config.get("efs_throughput_mode") or "bursting"  # bursting, provisioned or elastic
+EFS_PROVISIONED_THROUGHPUT = config.get_float("efs_provisioned_throughput")  # MiB/s, with efs_throughput_mode=provisioned
+EFS_PERFORMANCE_MODE = config.get("efs_performance_mode") or "generalPurpose"  # generalPurpose or maxIO
+EFS_MOUNT_OPTIONS = config.get("efs_mount_options") or "tls"  # For example: 'tls,noresvport,rsize=1048576,wsize=1048576'
+EFS_BENCHMARK = config.get_bool("efs_benchmark") or False  # Run fio against EFS from every node after the build.
+
+# The Workbench database, and an optional PgBouncer on every node that pools
+# the node's connections to it.
+DB_INSTANCE_CLASS = config.get("db_instance_class") or "db.t3.micro"
+DB_ALLOCATED_STORAGE = config.get_int("db_allocated_storage") or 5  # GiB
+DB_STORAGE_TYPE = config.get("db_storage_type")  # For example: 'gp3' or 'io1', defaults to the RDS default.
+DB_IOPS = config.get_int("db_iops")  # Provisioned IOPS, with db_storage_type io1 or gp3.
+DB_CONNECTION_TIMEOUT = config.get_int("db_connection_timeout") or 12  # Seconds
+PGBOUNCER = config.get_bool("pgbouncer") or False
+PGBOUNCER_POOL_SIZE = config.get_int("pgbouncer_pool_size") or 20  # Database connections per node.
+
+LOAD_BALANCER = config.get_bool("load_balancer") or False  # Put an application load balancer in front of the nodes.
+STICKY_SESSION_SECONDS = config.get_int("sticky_session_seconds") or 86400  # How long a user stays on the same node.
+
+# In autoscaling mode an auto scaling group starts the nodes from a launch
+# template and they build themselves on first boot, instead of `pulumi up`
+# building each node over SSH.
+AUTOSCALING = config.get_bool("autoscaling") or False
+MIN_NODES = config.get_int("min_nodes") or NODE_COUNT
+MAX_NODES = config.get_int("max_nodes") or 2 * MIN_NODES
+SCALING_METRIC = config.get("scaling_metric") or "cpu"  # cpu or sessions
+SCALING_TARGET = config.get_float("scaling_target") or (60.0 if SCALING_METRIC == "cpu" else 10.0)  # Average CPU % or R sessions per node.
+NODE_BUILD_SECONDS = 1200  # How long a new node takes to build Workbench and pass its health check.
+
+# Recipes in templates/justfile that write the Workbench configuration. A change
+# to any of them is rolled out one node at a time.
+CONFIG_RECIPES = ["set-efs-conf", "remount-efs", "set-rserver-conf", "set-load-balancer", "set-pgbouncer-conf", "set-database-conf"]
 
 
 def get_private_key(file_path: str) -> str:
@@ -31,17 +76,42 @@ def get_private_key(file_path: str) -> str:
     return private_key
 
 
+def zone_subnets() -> List[ec2.AwaitableGetSubnetResult]:
+    """
+    The subnets to use, each in its own availability zone. Without
+    `subnet_ids` these are the default subnets of the default VPC.
+    """
+    if SUBNET_IDS:
+        subnets = [ec2.get_subnet(id=subnet_id) for subnet_id in SUBNET_IDS]
+    else:
+        vpc = ec2.get_vpc(default=True)
+        subnet_ids = ec2.get_subnets(filters=[
+            {"name": "vpc-id", "values": [vpc.id]},
+            {"name": "default-for-az", "values": ["true"]},
+        ]).ids
+        subnets = sorted((ec2.get_subnet(id=subnet_id) for subnet_id in subnet_ids), key=lambda x: x.availability_zone)
+
+    # EFS allows one mount target per availability zone.
+    zones = [subnet.availability_zone for subnet in subnets]
+    shared = sorted({zone for zone in zones if zones.count(zone) > 1})
+    if shared:
+        raise ValueError(f"subnet_ids has more than one subnet in {', '.join(shared)}")
+    return subnets
+
+
 def make_rsw_server(
     name: str, 
     tags: Dict, 
     key_pair: ec2.KeyPair, 
-    vpc_group_ids: List[str]
+    vpc_group_ids: List[str],
+    subnet_id: str
 ):
     # Stand up a server.
     server = ec2.Instance(
         f"rstudio-workbench-{name}",
         instance_type="t3.medium",
         vpc_security_group_ids=vpc_group_ids,
+        subnet_id=subnet_id,
         ami="ami-0fb653ca2d3203ac1",  # Ubuntu Server 20.04 LTS (HVM), SSD Volume Type
         tags=tags,
         key_name=key_pair.key_name
@@ -51,10 +121,265 @@ def make_rsw_server(
     pulumi.export(f'rsw_{name}_public_ip', server.public_ip)
     pulumi.export(f'rsw_{name}_public_dns', server.public_dns)
     pulumi.export(f'rsw_{name}_subnet_id', server.subnet_id)
+    pulumi.export(f'rsw_{name}_availability_zone', server.availability_zone)
+
+    return server
+
+
+def content_hash(content: str, **variables) -> str:
+    """
+    Hash rendered content together with the variables it was rendered from. Used
+    as a trigger, a step re-runs exactly when its output would change.
+    """
+    payload = json.dumps(variables, sort_keys=True, default=str) + "\n" + content
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
+
+def justfile_recipes(path: str, recipes: List[str]) -> str:
+    """
+    The source of some recipes in a justfile (the recipe line and its indented
+    body), without the rest of the file.
+    """
+    text = Path(path).read_text()
+    sources = []
+    for recipe in recipes:
+        match = re.search(rf"^{re.escape(recipe)}\b.*?(?=^\S|\Z)", text, flags=re.MULTILINE | re.DOTALL)
+        if match is None:
+            raise ValueError(f"Recipe {recipe!r} not found in {path}")
+        sources.append(match.group(0))
+    return "".join(sources)
+
+
+def make_apt_cache(tags: Dict, key_pair: ec2.KeyPair) -> ec2.Instance:
+    """
+    A small host running apt-cacher-ng, reachable from inside the VPC.
+    """
+    vpc = ec2.get_vpc(default=True)
+    security_group = ec2.SecurityGroup(
+        "apt-cache-sg",
+        description=NAME + " apt cache security group for Pulumi deployment",
+        ingress=[
+            {"protocol": "TCP", "from_port": 22, "to_port": 22, 'cidr_blocks': ['0.0.0.0/0'], "description": "SSH"},
+            {"protocol": "TCP", "from_port": APT_CACHE_PORT, "to_port": APT_CACHE_PORT, 'cidr_blocks': [vpc.cidr_block], "description": "APT-CACHER-NG"},
+        ],
+        egress=[
+            {"protocol": "All", "from_port": -1, "to_port": -1, 'cidr_blocks': ['0.0.0.0/0'], "description": "Allow all outbout traffic"},
+        ],
+        tags=tags
+    )
+    server = ec2.Instance(
+        "apt-cache",
+        instance_type="t3.small",
+        vpc_security_group_ids=[security_group.id],
+        ami="ami-0fb653ca2d3203ac1",  # Ubuntu Server 20.04 LTS (HVM), SSD Volume Type
+        user_data=Path("templates/apt-cache-user-data.sh").read_text(),
+        tags=tags,
+        key_name=key_pair.key_name
+    )
+    pulumi.export("apt_cache_public_dns", server.public_dns)
+    pulumi.export("apt_cache_report_url", pulumi.Output.concat("http://", server.private_ip, f":{APT_CACHE_PORT}/acng-report.html"))
     return server
 
 
+def make_load_balancer(
+    servers: Dict[int, ec2.Instance],
+    subnets: List[ec2.AwaitableGetSubnetResult],
+    tags: Dict
+) -> Tuple[lb.LoadBalancer, lb.TargetGroup]:
+    """
+    An application load balancer sending users to healthy nodes. A user stays
+    on the node they were sent to first (sticky sessions). Nodes started by an
+    auto scaling group are added to the target group by the group.
+    """
+    if len(subnets) < 2:
+        raise ValueError("The load balancer needs subnets in at least two availability zones")
+    vpc_id = subnets[0].vpc_id
+    security_group = ec2.SecurityGroup(
+        "rsw-ha-lb-sg",
+        description=NAME + " load balancer security group for Pulumi deployment",
+        vpc_id=vpc_id,
+        ingress=[
+            {"protocol": "TCP", "from_port": 80, "to_port": 80, 'cidr_blocks': ['0.0.0.0/0'], "description": "HTTP"},
+        ],
+        egress=[
+            {"protocol": "All", "from_port": -1, "to_port": -1, 'cidr_blocks': ['0.0.0.0/0'], "description": "Allow all outbout traffic"},
+        ],
+        tags=tags
+    )
+    load_balancer = lb.LoadBalancer(
+        "rsw-ha-lb",
+        load_balancer_type="application",
+        security_groups=[security_group.id],
+        subnets=[subnet.id for subnet in subnets],
+        # Sessions keep long-polling requests open.
+        idle_timeout=300,
+        tags=tags
+    )
+    target_group = lb.TargetGroup(
+        "rsw-ha-tg",
+        port=8787,
+        protocol="HTTP",
+        vpc_id=vpc_id,
+        # Let a node finish its requests before it is restarted in a rollout.
+        deregistration_delay=30,
+        health_check={
+            "path": "/health-check",
+            "matcher": "200",
+            "interval": 15,
+            "healthy_threshold": 2,
+            "unhealthy_threshold": 3,
+        },
+        stickiness={"type": "lb_cookie", "cookie_duration": STICKY_SESSION_SECONDS, "enabled": True},
+        tags=tags
+    )
+    for name, server in servers.items():
+        lb.TargetGroupAttachment(
+            f"rsw-ha-tg-{name}",
+            target_group_arn=target_group.arn,
+            target_id=server.id,
+            port=8787
+        )
+    lb.Listener(
+        "rsw-ha-lb-http",
+        load_balancer_arn=load_balancer.arn,
+        port=80,
+        protocol="HTTP",
+        default_actions=[{"type": "forward", "target_group_arn": target_group.arn}]
+    )
+    pulumi.export("load_balancer_dns", load_balancer.dns_name)
+    pulumi.export("rsw_url", pulumi.Output.concat("http://", load_balancer.dns_name))
+    return load_balancer, target_group
+
+
+def node_user_data(settings: Dict[str, pulumi.Input]) -> pulumi.Output:
+    """
+    User data for a node started by the auto scaling group: the settings, the
+    justfile and `templates/node-user-data.sh`. Gzipped (cloud-init unpacks
+    it) to stay below the 16 KB limit, and base64 encoded for the template.
+    """
+    def render(values: List) -> str:
+        lines = ["#!/bin/bash"]
+        lines += [f"export {key}={shlex.quote(str(value))}" for key, value in zip(settings, values)]
+        lines += ["cat > /home/ubuntu/justfile <<'JUSTFILE'", Path("templates/justfile").read_text().rstrip("\n"), "JUSTFILE"]
+        lines += [Path("templates/node-user-data.sh").read_text()]
+        return base64.b64encode(gzip.compress("\n".join(lines).encode("utf-8"), mtime=0)).decode("ascii")
+
+    return pulumi.Output.all(*settings.values()).apply(render)
+
+
+def make_node_group(
+    settings: Dict[str, pulumi.Input],
+    subnets: List[ec2.AwaitableGetSubnetResult],
+    target_group: lb.TargetGroup,
+    vpc_group_ids: List[str],
+    key_pair: ec2.KeyPair,
+    tags: Dict
+) -> autoscaling.Group:
+    """
+    An auto scaling group of Workbench nodes behind the load balancer. A new
+    node reads the license from the parameter store, builds Workbench on first
+    boot and joins the cluster through the shared database and EFS. The group
+    scales on the nodes' average CPU or number of R sessions.
+    """
+    group_name = f"{NAME}-rsw-ha-nodes"
+
+    license_parameter = ssm.Parameter(
+        "rsw-license",
+        name=f"/{NAME}/rsw-ha/rsw-license",
+        type="SecureString",
+        value=RSW_LICENSE,
+        tags=tags
+    )
+    role = iam.Role(
+        "rsw-ha-node-role",
+        assume_role_policy=json.dumps({
+            "Version": "2012-10-17",
+            "Statement": [{"Effect": "Allow", "Principal": {"Service": "ec2.amazonaws.com"}, "Action": "sts:AssumeRole"}],
+        }),
+        tags=tags
+    )
+    iam.RolePolicy(
+        "rsw-ha-node-policy",
+        role=role.id,
+        policy=license_parameter.arn.apply(lambda arn: json.dumps({
+            "Version": "2012-10-17",
+            "Statement": [
+                {"Effect": "Allow", "Action": "ssm:GetParameter", "Resource": arn},
+                {"Effect": "Allow", "Action": "cloudwatch:PutMetricData", "Resource": "*"},
+            ],
+        }))
+    )
+    profile = iam.InstanceProfile("rsw-ha-node-profile", role=role.name, tags=tags)
+
+    launch_template = ec2.LaunchTemplate(
+        "rsw-ha-node",
+        image_id="ami-0fb653ca2d3203ac1",  # Ubuntu Server 20.04 LTS (HVM), SSD Volume Type
+        instance_type="t3.medium",
+        key_name=key_pair.key_name,
+        vpc_security_group_ids=vpc_group_ids,
+        iam_instance_profile={"arn": profile.arn},
+        user_data=node_user_data(settings | {"RSW_LICENSE_PARAMETER": license_parameter.name, "ASG_NAME": group_name}),
+        metadata_options={"http_endpoint": "enabled", "http_tokens": "required"},
+        tag_specifications=[{"resource_type": "instance", "tags": tags | {"Name": f"{NAME}-rsw"}}],
+        update_default_version=True,
+        tags=tags
+    )
+    group = autoscaling.Group(
+        "rsw-ha-nodes",
+        name=group_name,
+        min_size=MIN_NODES,
+        max_size=MAX_NODES,
+        vpc_zone_identifiers=[subnet.id for subnet in subnets],
+        launch_template={"id": launch_template.id, "version": launch_template.latest_version.apply(str)},
+        target_group_arns=[target_group.arn],
+        health_check_type="ELB",
+        health_check_grace_period=NODE_BUILD_SECONDS,
+        default_instance_warmup=NODE_BUILD_SECONDS,
+        # A new launch template (e.g. a config change) replaces the nodes a
+        # few at a time, keeping half of them serving.
+        instance_refresh={"strategy": "Rolling", "preferences": {"min_healthy_percentage": 50}}
+    )
+
+    if SCALING_METRIC == "cpu":
+        target = {"predefined_metric_specification": {"predefined_metric_type": "ASGAverageCPUUtilization"}}
+    elif SCALING_METRIC == "sessions":
+        # Published by every node with `just publish-session-metric`.
+        target = {"customized_metric_specification": {
+            "namespace": "RStudio/Workbench",
+            "metric_name": "ActiveSessions",
+            "statistic": "Average",
+            "metric_dimensions": [{"name": "AutoScalingGroupName", "value": group.name}],
+        }}
+    else:
+        raise ValueError(f"scaling_metric must be 'cpu' or 'sessions', not {SCALING_METRIC!r}")
+    autoscaling.Policy(
+        "rsw-ha-scaling",
+        autoscaling_group_name=group.name,
+        policy_type="TargetTrackingScaling",
+        estimated_instance_warmup=NODE_BUILD_SECONDS,
+        target_tracking_configuration=target | {"target_value": SCALING_TARGET}
+    )
+
+    pulumi.export("rsw_asg_name", group.name)
+    pulumi.export("rsw_license_parameter", license_parameter.name)
+    return group
+
+
+def apt_proxy_script(proxy_ip: pulumi.Output) -> pulumi.Output:
+    """
+    Point apt at the cache. apt asks `apt-proxy-detect` before every download,
+    so the server falls back to the mirrors whenever the cache is unreachable.
+    """
+    proxy = pulumi.Output.concat(proxy_ip, f"/{APT_CACHE_PORT}")
+    return pulumi.Output.concat(
+        "for i in $(seq 60); do timeout 2 bash -c '</dev/tcp/", proxy, "' 2>/dev/null && break; sleep 5; done;\n",
+        "printf '#!/bin/bash\\nif timeout 2 bash -c \"</dev/tcp/", proxy, "\" 2>/dev/null; ",
+        "then echo http://", proxy_ip, f":{APT_CACHE_PORT}; else echo DIRECT; fi\\n' | sudo tee /usr/local/bin/apt-proxy-detect > /dev/null;\n",
+        "sudo chmod +x /usr/local/bin/apt-proxy-detect;\n",
+        """echo 'Acquire::http::Proxy-Auto-Detect "/usr/local/bin/apt-proxy-detect";' | sudo tee /etc/apt/apt.conf.d/01proxy;""",
+    )
+
+
 def main():
     # --------------------------------------------------------------------------
     # Tags to apply to all resources.
@@ -91,43 +416,78 @@ def main():
     )
     
     # --------------------------------------------------------------------------
-    # Stand up the servers
+    # Stand up the servers, spread over the availability zones in turn. In
+    # autoscaling mode the auto scaling group starts them later on.
     # --------------------------------------------------------------------------
-    rsw_server_1 = make_rsw_server(
-        "1", 
-        tags=tags | {"Name": f"{NAME}-rsw-1"},
-        key_pair=key_pair,
-        vpc_group_ids=[rsw_security_group.id]
-    )
-    rsw_server_2 = make_rsw_server(
-        "2", 
-        tags=tags | {"Name": f"{NAME}-rsw-2"},
-        key_pair=key_pair,
-        vpc_group_ids=[rsw_security_group.id]
-    )
+    if AUTOSCALING and not LOAD_BALANCER:
+        raise ValueError("autoscaling needs the load balancer")
+    if AUTOSCALING and (APT_CACHE or TIMELINE or EFS_BENCHMARK):
+        raise ValueError("apt_cache, timeline and efs_benchmark need nodes built over SSH, they don't work with autoscaling")
+
+    apt_cache = make_apt_cache(tags | {"Name": f"{NAME}-apt-cache"}, key_pair) if APT_CACHE else None
+
+    # The load balancer and an auto scaling group span every zone, fixed nodes
+    # as many zones as there are nodes.
+    zones = zone_subnets()
+    subnets = zones if AUTOSCALING else zones[:NODE_COUNT]
+    node_subnet = {node: subnets[(node - 1) % len(subnets)] for node in range(1, NODE_COUNT + 1)}
+    servers = {} if AUTOSCALING else {
+        node: make_rsw_server(
+            str(node), 
+            tags=tags | {"Name": f"{NAME}-rsw-{node}"},
+            key_pair=key_pair,
+            vpc_group_ids=[rsw_security_group.id],
+            subnet_id=node_subnet[node].id
+        )
+        for node in range(1, NODE_COUNT + 1)
+    }
+    if servers:
+        pulumi.export("rsw_public_ips", [server.public_ip for server in servers.values()])
+
+    if LOAD_BALANCER:
+        load_balancer, target_group = make_load_balancer(servers, zones, tags | {"Name": f"{NAME}-rsw-ha-lb"})
+    www_host_name = load_balancer.dns_name if LOAD_BALANCER else ""
 
     # --------------------------------------------------------------------------
     # Create EFS.
     # --------------------------------------------------------------------------
     # Create a new file system.
-    file_system = efs.FileSystem("efs-rsw-ha", tags=tags | {"Name": f"{NAME}-rsw-ha-efs"})
+    if EFS_THROUGHPUT_MODE == "provisioned" and not EFS_PROVISIONED_THROUGHPUT:
+        raise ValueError("efs_throughput_mode 'provisioned' needs efs_provisioned_throughput (MiB/s)")
+    file_system = efs.FileSystem(
+        "efs-rsw-ha",
+        throughput_mode=EFS_THROUGHPUT_MODE,
+        provisioned_throughput_in_mibps=EFS_PROVISIONED_THROUGHPUT if EFS_THROUGHPUT_MODE == "provisioned" else None,
+        performance_mode=EFS_PERFORMANCE_MODE,
+        tags=tags | {"Name": f"{NAME}-rsw-ha-efs"},
+        # Holds every home directory, and some changes (e.g. the performance
+        # mode) replace it.
+        opts=pulumi.ResourceOptions(protect=True)
+    )
     pulumi.export("efs_id", file_system.id)
 
-    # Create a mount target. Assumes that the servers are on the same subnet id.
-    mount_target = efs.MountTarget(
-        f"mount-target-rsw",
-        file_system_id=file_system.id,
-        subnet_id=rsw_server_1.subnet_id,
-        security_groups=[rsw_security_group.id]
-    )
+    # Create a mount target in every availability zone with a node. Each node
+    # mounts through the one in its own zone.
+    mount_targets = {}
+    for subnet in subnets:
+        mount_targets[subnet.id] = efs.MountTarget(
+            f"mount-target-rsw-{subnet.availability_zone}",
+            file_system_id=file_system.id,
+            subnet_id=subnet.id,
+            security_groups=[rsw_security_group.id],
+            # Keep the single mount target of earlier versions.
+            opts=pulumi.ResourceOptions(aliases=[pulumi.Alias(name="mount-target-rsw")]) if subnet is subnets[0] else None
+        )
     
     # --------------------------------------------------------------------------
     # Create a postgresql database.
     # --------------------------------------------------------------------------
     db = rds.Instance(
         "rsw-db",
-        instance_class="db.t3.micro",
-        allocated_storage=5,
+        instance_class=DB_INSTANCE_CLASS,
+        allocated_storage=DB_ALLOCATED_STORAGE,
+        storage_type=DB_STORAGE_TYPE,
+        iops=DB_IOPS,
         username="rsw_db_admin",
         password="password",
         db_name="rsw",
@@ -144,28 +504,66 @@ def main():
     pulumi.export("db_domain", db.domain)
 
     # --------------------------------------------------------------------------
-    # Install required software one each server
+    # In autoscaling mode the nodes build themselves, from the same settings
+    # the other nodes get in their .env file.
+    # --------------------------------------------------------------------------
+    if AUTOSCALING:
+        mount_target_ips = [
+            pulumi.Output.concat(subnet.availability_zone, "=", mount_targets[subnet.id].ip_address)
+            for subnet in subnets
+        ]
+        settings = {
+            "DB_ADDRESS": db.address,
+            "DB_CONNECTION_TIMEOUT": DB_CONNECTION_TIMEOUT,
+            "PGBOUNCER": str(PGBOUNCER).lower(),
+            "PGBOUNCER_POOL_SIZE": PGBOUNCER_POOL_SIZE,
+            "EFS_ID": file_system.id,
+            "EFS_MOUNT_OPTIONS": EFS_MOUNT_OPTIONS,
+            "EFS_MOUNT_TARGET_IPS": pulumi.Output.all(*mount_target_ips).apply(" ".join),
+            "LOAD_BALANCER_DNS": www_host_name,
+        }
+        make_node_group(
+            settings,
+            subnets,
+            target_group,
+            vpc_group_ids=[rsw_security_group.id],
+            key_pair=key_pair,
+            tags=tags
+        )
+        return
+
+    # --------------------------------------------------------------------------
+    # Install required software one each server. The servers are built at the
+    # same time.
     # --------------------------------------------------------------------------
-    for name, server in zip(
-        [1, 2],
-        [rsw_server_1, rsw_server_2]
-    ):
+    builds = []
+    connections = {}
+    justfiles = {}
+    for name, server in servers.items():
         connection = remote.ConnectionArgs(
             host=server.public_dns, 
             user="ubuntu", 
             private_key=private_key
         )
+        connections[name] = connection
 
         _set_env = remote.Command(
             f"server-{name}-set-env", 
             create=pulumi.Output.concat(
                 'echo "export SERVER_IP_ADDRESS=', server.public_ip,         '" > .env;\n',
                 'echo "export DB_ADDRESS=',        db.address,               '" >> .env;\n',
+                f'echo "export DB_CONNECTION_TIMEOUT={DB_CONNECTION_TIMEOUT}" >> .env;\n',
+                f'echo "export PGBOUNCER={str(PGBOUNCER).lower()}" >> .env;\n',
+                f'echo "export PGBOUNCER_POOL_SIZE={PGBOUNCER_POOL_SIZE}" >> .env;\n',
                 'echo "export EFS_ID=',            file_system.id,           '" >> .env;\n',
+                'echo "export LOAD_BALANCER_DNS=', www_host_name, '" >> .env;\n',
+                f'echo "export EFS_MOUNT_OPTIONS={EFS_MOUNT_OPTIONS}" >> .env;\n',
+                'echo "export EFS_MOUNT_TARGET_IP=', mount_targets[node_subnet[name].id].ip_address, '" >> .env;\n',
                 'echo "export RSW_LICENSE=',       RSW_LICENSE, '" >> .env;',
+                '\necho "export TIMELINE=/home/ubuntu/timeline.py" >> .env;' if TIMELINE else '',
             ), 
             connection=connection, 
-            opts=pulumi.ResourceOptions(depends_on=[server, db, file_system])
+            opts=pulumi.ResourceOptions(depends_on=[server, db, file_system, mount_targets[node_subnet[name].id]])
         )
 
         _install_justfile = remote.Command(
@@ -183,16 +581,124 @@ def main():
             local_path="templates/justfile", 
             remote_path='justfile', 
             connection=connection, 
+            triggers=[content_hash(Path("templates/justfile").read_text())],
             opts=pulumi.ResourceOptions(depends_on=[server])
         )
+        justfiles[name] = _copy_justfile
         
+        build_dependencies = [_set_env, _install_justfile, _copy_justfile]
+        if APT_CACHE:
+            _apt_proxy = remote.Command(
+                f"server-{name}-apt-proxy",
+                create=apt_proxy_script(apt_cache.private_ip),
+                connection=connection,
+                opts=pulumi.ResourceOptions(depends_on=[server, apt_cache])
+            )
+            build_dependencies.append(_apt_proxy)
+        build_command = """export PATH="$PATH:$HOME/bin"; just build-rsw"""
+        if TIMELINE:
+            _copy_timeline = remote.CopyFile(
+                f"server-{name}-copy-timeline",
+                local_path="templates/timeline.py",
+                remote_path="timeline.py",
+                connection=connection,
+                triggers=[content_hash(Path("templates/timeline.py").read_text())],
+                opts=pulumi.ResourceOptions(depends_on=[server])
+            )
+            build_dependencies.append(_copy_timeline)
+            # A failed build has no stack output, print its timeline with the error.
+            build_command = """export PATH="$PATH:$HOME/bin"; chmod +x ~/timeline.py; rm -f ~/timeline.jsonl; ~/timeline.py just build-rsw || { status=$?; echo "Timeline of the failed build:" >&2; cat ~/timeline.jsonl >&2; exit $status; }"""
+
         _build_rsw = remote.Command(
             f"server-{name}-build-rsw", 
             # create="alias just='/home/ubuntu/bin/just'; just build-rsw", 
-            create="""export PATH="$PATH:$HOME/bin"; just build-rsw""", 
+            create=build_command, 
             connection=connection, 
-            opts=pulumi.ResourceOptions(depends_on=[_set_env, _install_justfile, _copy_justfile])
+            opts=pulumi.ResourceOptions(depends_on=build_dependencies)
+        )
+        builds.append(_build_rsw)
+
+        if TIMELINE:
+            # Bring the timeline back so it can be read with `pulumi stack output`.
+            _collect_timeline = remote.Command(
+                f"server-{name}-collect-timeline",
+                create="cat ~/timeline.jsonl",
+                connection=connection,
+                triggers=[_build_rsw.id],
+                opts=pulumi.ResourceOptions(depends_on=[_build_rsw])
+            )
+            pulumi.export(
+                f"rsw_{name}_timeline",
+                _collect_timeline.stdout.apply(lambda x: [json.loads(line) for line in x.splitlines() if line])
+            )
+
+    # --------------------------------------------------------------------------
+    # Check that every node joined the cluster
+    # --------------------------------------------------------------------------
+    _verify_cluster = remote.Command(
+        "verify-cluster",
+        create=pulumi.Output.concat(
+            """export PATH="$PATH:$HOME/bin"; just verify-cluster """,
+            *[pulumi.Output.concat(" ", server.private_ip) for server in servers.values()],
+        ),
+        connection=remote.ConnectionArgs(host=servers[1].public_dns, user="ubuntu", private_key=private_key),
+        triggers=[build.id for build in builds],
+        opts=pulumi.ResourceOptions(depends_on=builds)
+    )
+    pulumi.export("rsw_cluster_status", _verify_cluster.stdout)
+
+    # --------------------------------------------------------------------------
+    # Roll configuration changes out one node at a time. Each node is
+    # restarted and has to be healthy in the load balancer before the next one
+    # starts, a failure stops the rollout.
+    # --------------------------------------------------------------------------
+    # The config files are rendered on the nodes from these recipes and .env.
+    def config_hash(address: str, www_host_name: str, mount_target_ip: str) -> str:
+        return content_hash(
+            justfile_recipes("templates/justfile", CONFIG_RECIPES),
+            DB_ADDRESS=address,
+            LOAD_BALANCER_DNS=www_host_name,
+            DB_CONNECTION_TIMEOUT=DB_CONNECTION_TIMEOUT,
+            PGBOUNCER=PGBOUNCER,
+            PGBOUNCER_POOL_SIZE=PGBOUNCER_POOL_SIZE,
+            EFS_MOUNT_OPTIONS=EFS_MOUNT_OPTIONS,
+            EFS_MOUNT_TARGET_IP=mount_target_ip,
+        )
+
+    previous = [_verify_cluster]
+    for name in servers:
+        mount_target_ip = mount_targets[node_subnet[name].id].ip_address
+        _rollout = remote.Command(
+            f"server-{name}-rollout-config",
+            create="""export PATH="$PATH:$HOME/bin"; just rollout-config""",
+            connection=connections[name],
+            triggers=[pulumi.Output.all(db.address, www_host_name, mount_target_ip).apply(lambda args: config_hash(*args))],
+            opts=pulumi.ResourceOptions(depends_on=previous + [justfiles[name]])
+        )
+        previous = [_rollout]
+
+    if EFS_BENCHMARK:
+        # Every node runs fio at the same time, like a cluster under load.
+        for name in servers:
+            _bench_efs = remote.Command(
+                f"server-{name}-bench-efs",
+                create="""export PATH="$PATH:$HOME/bin"; just bench-efs""",
+                connection=connections[name],
+                triggers=[build.id for build in builds],
+                opts=pulumi.ResourceOptions(depends_on=builds)
+            )
+            pulumi.export(f"rsw_{name}_efs_benchmark", _bench_efs.stdout.apply(lambda x: json.loads(x) if x else None))
+
+    if APT_CACHE:
+        # Read the hit rates once every server has been built through the cache.
+        _apt_cache_stats = remote.Command(
+            "apt-cache-stats",
+            create="apt-cache-stats",
+            connection=remote.ConnectionArgs(host=apt_cache.public_dns, user="ubuntu", private_key=private_key),
+            triggers=[build.id for build in builds],
+            opts=pulumi.ResourceOptions(depends_on=builds)
         )
+        pulumi.export("apt_cache_stats", _apt_cache_stats.stdout.apply(lambda x: json.loads(x) if x else None))
 
 
 main()
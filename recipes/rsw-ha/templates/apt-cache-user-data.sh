@@ -0,0 +1,24 @@
+#!/bin/bash
+# Runs once when the apt cache host first boots. Installs apt-cacher-ng on port
+# 3142 and an `apt-cache-stats` command that reports how well the cache does.
+export DEBIAN_FRONTEND=noninteractive
+echo "apt-cacher-ng apt-cacher-ng/tunnelenable boolean false" | debconf-set-selections
+apt-get update
+apt-get install -y apt-cacher-ng
+systemctl enable --now apt-cacher-ng
+
+cat > /usr/local/bin/apt-cache-stats <<'STATS'
+#!/bin/bash
+# Print cache hit rates as JSON, from apt-cacher-ng's transfer log. Every file
+# sent to a client is logged with "O", every file fetched from a mirror with "I".
+cat /var/log/apt-cacher-ng/apt-cacher.log 2>/dev/null | awk -F'|' '
+    $2 == "O" { requests += 1; served += $3 }
+    $2 == "I" { misses += 1; fetched += $3 }
+    END {
+        hits = requests > misses ? requests - misses : 0
+        saved = served > fetched ? served - fetched : 0
+        printf "{\"requests\": %.0f, \"hits\": %.0f, \"bytes_served\": %.0f, \"bytes_fetched\": %.0f, ", requests, hits, served, fetched
+        printf "\"hit_rate\": %.3f, \"byte_hit_rate\": %.3f}\n", requests ? hits / requests : 0, served ? saved / served : 0
+    }'
+STATS
+chmod +x /usr/local/bin/apt-cache-stats
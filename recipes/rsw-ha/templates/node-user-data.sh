@@ -0,0 +1,74 @@
+# Runs once when a node started by the auto scaling group first boots, after
+# the settings and the justfile above. Builds Workbench like `pulumi up` does
+# for the other nodes and joins the cluster through the shared database.
+set -euxo pipefail
+export DEBIAN_FRONTEND=noninteractive
+cd /home/ubuntu
+
+imds() {
+    local token
+    token=$(curl -fsS -X PUT -H "X-aws-ec2-metadata-token-ttl-seconds: 300" http://169.254.169.254/latest/api/token)
+    curl -fsS -H "X-aws-ec2-metadata-token: $token" "http://169.254.169.254/latest/meta-data/$1"
+}
+
+apt-get update
+apt-get install -y awscli
+region=$(imds placement/region)
+zone=$(imds placement/availability-zone)
+server_ip=$(imds public-ipv4 || imds local-ipv4)
+# Keep the license out of the trace in cloud-init-output.log.
+set +x
+license=$(aws ssm get-parameter --region "$region" --name "$RSW_LICENSE_PARAMETER" --with-decryption --query Parameter.Value --output text)
+
+# Mount EFS through the mount target in this node's zone.
+mount_target_ip=""
+for entry in $EFS_MOUNT_TARGET_IPS; do
+    if [ "${entry%%=*}" = "$zone" ]; then mount_target_ip=${entry#*=}; fi
+done
+
+cat > .env <<EOF
+export SERVER_IP_ADDRESS=$server_ip
+export DB_ADDRESS=$DB_ADDRESS
+export DB_CONNECTION_TIMEOUT=$DB_CONNECTION_TIMEOUT
+export PGBOUNCER=$PGBOUNCER
+export PGBOUNCER_POOL_SIZE=$PGBOUNCER_POOL_SIZE
+export EFS_ID=$EFS_ID
+export EFS_MOUNT_OPTIONS=$EFS_MOUNT_OPTIONS
+export EFS_MOUNT_TARGET_IP=$mount_target_ip
+export LOAD_BALANCER_DNS=$LOAD_BALANCER_DNS
+export RSW_LICENSE=$license
+export ASG_NAME=$ASG_NAME
+export AWS_DEFAULT_REGION=$region
+EOF
+set -x
+chmod 0600 .env
+chown ubuntu:ubuntu .env justfile
+
+sudo -u ubuntu -H bash -c "curl --proto '=https' --tlsv1.2 -sSf https://just.systems/install.sh | bash -s -- --to ~/bin"
+echo 'export PATH="$PATH:$HOME/bin"' >> .bashrc
+sudo -u ubuntu -H bash -c 'cd ~ && export PATH="$PATH:$HOME/bin" && just build-rsw'
+
+# When the node is terminated on scale in, suspend its sessions to EFS so
+# users resume them on another node, and give the license activation back.
+cat > /etc/systemd/system/rsw-node-shutdown.service <<'UNIT'
+[Unit]
+Description=Suspend RStudio Workbench sessions and deactivate the license on shutdown
+After=network-online.target rstudio-server.service
+Wants=network-online.target
+
+[Service]
+Type=oneshot
+RemainAfterExit=yes
+ExecStart=/bin/true
+ExecStop=/usr/sbin/rstudio-server suspend-all
+ExecStop=/usr/sbin/rstudio-server license-manager deactivate
+TimeoutStopSec=300
+
+[Install]
+WantedBy=multi-user.target
+UNIT
+systemctl daemon-reload
+systemctl enable --now rsw-node-shutdown.service
+
+# Report the sessions on this node every minute, the group can scale on them.
+echo '* * * * * ubuntu cd /home/ubuntu && PATH="$PATH:/home/ubuntu/bin" just publish-session-metric > /dev/null 2>&1' > /etc/cron.d/rsw-session-metric
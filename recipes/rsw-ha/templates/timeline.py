@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Run a command and append a timing record for it to ~/timeline.jsonl.
+
+    timeline.py just install-r
+
+Each record holds the step name, its parent step (when called from inside
+another timed step), start and end time, exit code, the peak resident memory
+of the largest child process and the bytes received on the network while the
+step ran. The network counter is host wide, so steps that run at the same time
+share their downloads.
+
+The exit code of the command is passed through unchanged.
+
+This is the only copy, recipes/rsw-single-server/server-side-timeline.py is a
+symlink to it.
+"""
+
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+TIMELINE_FILE = os.path.expanduser("~/timeline.jsonl")
+
+
+def received_bytes() -> int:
+    total = 0
+    with open("/proc/net/dev") as f:
+        for line in f.readlines()[2:]:
+            interface, counters = line.split(":", 1)
+            if interface.strip() != "lo":
+                total += int(counters.split()[0])
+    return total
+
+
+def main(argv):
+    command = argv[1:]
+    if not command:
+        print(__doc__, file=sys.stderr)
+        return 2
+    words = command[1:] if command[0] == "just" else command
+    if words[:1] == ["step"]:
+        # `just step <recipe>` only runs the recipe when it is not done yet.
+        words = words[1:]
+    step = " ".join(words)
+
+    env = dict(os.environ, TIMELINE_PARENT=step)
+    start, rx_start = time.time(), received_bytes()
+    exit_code = subprocess.call(command, env=env)
+    end, rx_end = time.time(), received_bytes()
+
+    record = {
+        "step": step,
+        "parent": os.environ.get("TIMELINE_PARENT"),
+        "start": start,
+        "end": end,
+        "seconds": round(end - start, 3),
+        "exit_code": exit_code,
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        "rx_bytes": rx_end - rx_start,
+    }
+    with open(TIMELINE_FILE, "a") as f:
+        f.write(json.dumps(record) + "\n")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -1,15 +1,21 @@
+import base64
+import functools
+import gzip
+import io
+import json
+import tarfile
 from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Any, Dict, Tuple
 
 import pulumi
 import pulumi_tls as tls
-import requests
 import jinja2
 from pulumi_aws import ec2
 from pulumi_command import remote
-from rich import print, inspect
 import hashlib
-from Crypto.PublicKey import RSA
+
+import dailies
 
 # Setup pulumi configuration
 config = pulumi.Config()
@@ -21,6 +27,9 @@ class ConfigValues:
     daily: bool = field(default_factory=lambda: config.require("daily").lower() in ("yes", "true", "t", "1"))
     ssl: bool = field(default_factory=lambda: config.require("ssl").lower() in ("yes", "true", "t", "1"))
     public_key: str = field(default_factory=lambda: config.require("public_key"))
+    daily_offline: bool = field(default_factory=lambda: (config.get("daily_offline") or "false").lower() in ("yes", "true", "t", "1"))
+    daily_cache_ttl: int = field(default_factory=lambda: config.get_int("daily_cache_ttl") or dailies.DEFAULT_TTL)
+    timeline: bool = field(default_factory=lambda: (config.get("timeline") or "false").lower() in ("yes", "true", "t", "1"))
 
 
 CONFIG_VALUES = ConfigValues()
@@ -42,28 +51,77 @@ def get_private_key(file_path: str) -> str:
 
 def get_latest_build(daily: bool) -> str:
     if daily:
-        url = "https://dailies.rstudio.com/rstudio/latest/index.json"
-        r = requests.get(url)
-        data = r.json()
-        link = data["products"]["workbench"]["platforms"]["bionic"]["link"]
-        filename = data["products"]["workbench"]["platforms"]["bionic"]["filename"]
+        link, filename = dailies.latest_workbench(
+            "bionic",
+            ttl=CONFIG_VALUES.daily_cache_ttl,
+            offline=CONFIG_VALUES.daily_offline,
+        )
     else:
         link = "https://download2.rstudio.org/server/bionic/amd64/rstudio-workbench-2022.02.3-492.pro3-amd64.deb"
         filename = "rstudio-workbench-2022.02.3-492.pro3-amd64.deb"
     return (link, filename)
 
 
-def create_template(path: str) -> jinja2.Template:
-    with open(path, 'r') as f:
-        template = jinja2.Template(f.read())
-    return template
+# Templates are compiled once per run, the bytecode cache carries the compiled
+# templates over to the next `pulumi preview` or `pulumi up`.
+JINJA_CACHE = Path(".jinja-cache")
+JINJA_CACHE.mkdir(exist_ok=True)
+TEMPLATES = jinja2.Environment(
+    loader=jinja2.FileSystemLoader("config"),
+    bytecode_cache=jinja2.FileSystemBytecodeCache(str(JINJA_CACHE)),
+)
 
 
-def hash_file(path: str) -> pulumi.Output:
-    with open(path, mode="r") as f:
-        text = f.read()
-    hash_str = hashlib.sha224(bytes(text, encoding='utf-8')).hexdigest()
-    return pulumi.Output.concat(hash_str)
+@functools.lru_cache(maxsize=None)
+def _render(name: str, variables: Tuple[Tuple[str, Any], ...]) -> str:
+    return TEMPLATES.get_template(name).render(**dict(variables))
+
+
+def render_template(name: str, **variables) -> str:
+    """
+    Render a template from `config/`. Each template is rendered once per set of
+    variables, so the trigger hash and the payload share the same render.
+    """
+    return _render(name, tuple(sorted(variables.items())))
+
+
+def config_bundle_script(files: Dict[str, str], target: str) -> str:
+    """
+    Send the files as one gzipped tar, check its sha256, unpack it next to
+    `target` and rename each file into place, so a failed transfer never leaves
+    a half-applied config behind.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as archive:
+        for name in sorted(files):
+            data = files[name].encode("utf-8")
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            archive.addfile(info, io.BytesIO(data))
+    # No timestamps in the archive, unchanged files give an unchanged command.
+    bundle = gzip.compress(buffer.getvalue(), mtime=0)
+    checksum = hashlib.sha256(bundle).hexdigest()
+    archive_path = f"/tmp/config-bundle-{checksum[:16]}.tar.gz"
+    return "\n".join([
+        "set -e;",
+        f"echo '{base64.b64encode(bundle).decode('ascii')}' | base64 -d > {archive_path};",
+        f"echo '{checksum}  {archive_path}' | sha256sum --check --quiet;",
+        f"staging=$(sudo mktemp -d {target}/.config-bundle.XXXXXX);",
+        f'sudo tar -xzf {archive_path} -C "$staging" --no-same-owner --touch;',
+        *[f'sudo mv -f "$staging/{name}" {target}/{name};' for name in sorted(files)],
+        'sudo rmdir "$staging";',
+        f"rm -f {archive_path};",
+    ])
+
+
+def content_hash(content: str, **variables) -> str:
+    """
+    Trigger for a `render()` result: changes exactly when the rendered file or
+    its variables do.
+    """
+    payload = json.dumps(variables, sort_keys=True, default=str) + "\n" + content
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
 
 def main():
@@ -172,6 +230,7 @@ def main():
             'echo "export RSW_LICENSE=', CONFIG_VALUES.rsw_license, '" > .env;',
             'echo "export RSW_URL=', rsw_url,'" >> .env;',
             'echo "export RSW_FILENAME=', rsw_filename, '" >> .env;',
+            'echo "export TIMELINE=/home/ubuntu/timeline.py" >> .env;' if CONFIG_VALUES.timeline else '',
         ), 
         connection=connection, 
         opts=pulumi.ResourceOptions(depends_on=[rsw_server])
@@ -193,60 +252,79 @@ def main():
         remote_path='justfile', 
         connection=connection, 
         opts=pulumi.ResourceOptions(depends_on=[rsw_server]),
-        triggers=[hash_file("server-side-justfile")]
+        triggers=[content_hash(Path("server-side-justfile").read_text())]
     )
 
     # --------------------------------------------------------------------------
-    # Config files
+    # Build
     # --------------------------------------------------------------------------
-    file_path_rserver = "config/rserver.conf"
-    copy_rserver_conf = remote.Command(
-        "copy ~/rserver.conf",
-        create=pulumi.Output.concat(
-            'echo "', 
-            pulumi.Output.all(rsw_server.public_ip).apply(lambda x: create_template(file_path_rserver).render(ssl=CONFIG_VALUES.ssl)), 
-            '" > ~/rserver.conf'
-        ),
-        connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[rsw_server]),
-        triggers=[hash_file(file_path_rserver)]
-    )
-    
-    file_path_launcher = "config/launcher.conf"
-    copy_launcher_conf = remote.Command(
-        "copy ~/launcher.conf",
-        create=pulumi.Output.concat(
-            'echo "', 
-            pulumi.Output.all(rsw_server.public_ip).apply(lambda x: create_template(file_path_launcher).render()), 
-            '" > ~/launcher.conf'
-        ),
-        connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[rsw_server]),
-        triggers=[hash_file(file_path_launcher)]
-    )
-    
-    file_path_vscode = "config/vscode.extensions.conf"
-    copy_vscode_conf = remote.Command(
-        "copy ~/vscode.extensions.conf",
-        create=pulumi.Output.concat(
-            'echo "', 
-            pulumi.Output.all(rsw_server.public_ip).apply(lambda x: create_template(file_path_vscode).render()), 
-            '" > ~/vscode.extensions.conf'
-        ),
+
+    build_dependencies = [command_copy_justfile]
+    build_command = """export PATH="$PATH:$HOME/bin"; just build-rsw"""
+    if CONFIG_VALUES.timeline:
+        command_copy_timeline = remote.CopyFile(
+            f"copy ~/timeline.py",
+            local_path="server-side-timeline.py",
+            remote_path="timeline.py",
+            connection=connection,
+            opts=pulumi.ResourceOptions(depends_on=[rsw_server]),
+            triggers=[content_hash(Path("server-side-timeline.py").read_text())]
+        )
+        build_dependencies.append(command_copy_timeline)
+        # A failed build has no stack output, print its timeline with the error.
+        build_command = """export PATH="$PATH:$HOME/bin"; chmod +x ~/timeline.py; rm -f ~/timeline.jsonl; ~/timeline.py just build-rsw || { status=$?; echo "Timeline of the failed build:" >&2; cat ~/timeline.jsonl >&2; exit $status; }"""
+
+    command_build_rsw = remote.Command(
+        f"build rsw", 
+        create=build_command, 
         connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[rsw_server]),
-        triggers=[hash_file(file_path_vscode)]
+        opts=pulumi.ResourceOptions(depends_on=build_dependencies)
     )
 
     # --------------------------------------------------------------------------
-    # Build
+    # Config files
     # --------------------------------------------------------------------------
+    config_files = {
+        "rserver.conf": {"ssl": CONFIG_VALUES.ssl},
+        "launcher.conf": {},
+        "vscode.extensions.conf": {},
+    }
+    rendered = {
+        file_name: render_template(file_name, **variables)
+        for file_name, variables in config_files.items()
+    }
+    # All config files go over in one command, after the build has created
+    # /etc/rstudio and saved the original files.
+    command_install_config = remote.Command(
+        "install config bundle",
+        create=config_bundle_script(rendered, "/etc/rstudio"),
+        connection=connection,
+        opts=pulumi.ResourceOptions(depends_on=[command_build_rsw])
+    )
 
-    command_build_rsw = remote.Command(
-        f"build rsw", 
-        create="""export PATH="$PATH:$HOME/bin"; just build-rsw""", 
-        connection=connection, 
-        opts=pulumi.ResourceOptions(depends_on=[command_copy_justfile])
+    # Re-run whenever the config files or the certificate change, the build
+    # itself only runs once.
+    config_dependencies = [command_install_config, tls_crt_setup, tls_key_setup]
+    command_apply_config = remote.Command(
+        "apply config",
+        create="""export PATH="$PATH:$HOME/bin"; just apply-config""",
+        connection=connection,
+        triggers=[command.id for command in config_dependencies],
+        opts=pulumi.ResourceOptions(depends_on=[command_build_rsw, command_copy_justfile, *config_dependencies])
     )
 
+    if CONFIG_VALUES.timeline:
+        # Bring the timeline back so it can be read with `pulumi stack output`.
+        command_collect_timeline = remote.Command(
+            "collect ~/timeline.jsonl",
+            create="cat ~/timeline.jsonl",
+            connection=connection,
+            triggers=[command_build_rsw.id, command_apply_config.id],
+            opts=pulumi.ResourceOptions(depends_on=[command_build_rsw, command_apply_config])
+        )
+        pulumi.export(
+            "rsw_timeline",
+            command_collect_timeline.stdout.apply(lambda x: [json.loads(line) for line in x.splitlines() if line])
+        )
+
 main()
@@ -0,0 +1,88 @@
+"""
+Resolve the latest RStudio Workbench daily build.
+
+The dailies index is kept in a local JSON cache. Within the TTL the cached
+index is used as is; after that it is revalidated with `If-None-Match`, so an
+unchanged index costs a 304 and no download. Requests are bounded by a timeout
+and fall back to the last known index when the endpoint cannot be reached.
+Offline mode never touches the network.
+"""
+
+import json
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+INDEX_URL = "https://dailies.rstudio.com/rstudio/latest/index.json"
+CACHE_PATH = Path(".dailies-cache.json")
+DEFAULT_TTL = 3600
+DEFAULT_TIMEOUT = 5.0
+
+logger = logging.getLogger(__name__)
+
+
+def _load_cache(cache_path: Path, url: str) -> Optional[Dict[str, Any]]:
+    try:
+        cache = json.loads(cache_path.read_text())
+    except (OSError, ValueError):
+        return None
+    if cache.get("url") != url or "index" not in cache:
+        return None
+    return cache
+
+
+def _save_cache(cache_path: Path, cache: Dict[str, Any]) -> None:
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    tmp_path.write_text(json.dumps(cache, indent=2))
+    os.replace(tmp_path, cache_path)
+
+
+def fetch_index(
+    url: str = INDEX_URL,
+    cache_path: Path = CACHE_PATH,
+    ttl: float = DEFAULT_TTL,
+    timeout: float = DEFAULT_TIMEOUT,
+    offline: bool = False,
+) -> Dict[str, Any]:
+    """
+    The dailies index, from the cache when it is fresh enough.
+    """
+    cache_path = Path(cache_path)
+    cache = _load_cache(cache_path, url)
+    if offline:
+        if cache is None:
+            raise RuntimeError(f"Offline mode needs a cached dailies index in {cache_path}, none was found for {url}")
+        return cache["index"]
+    if cache is not None and time.time() - cache["fetched_at"] < ttl:
+        return cache["index"]
+
+    # Only imported when the index is actually fetched.
+    import requests
+
+    headers = {"If-None-Match": cache["etag"]} if cache and cache.get("etag") else {}
+    try:
+        r = requests.get(url, headers=headers, timeout=timeout)
+        if r.status_code == 304 and cache is not None:
+            cache["fetched_at"] = time.time()
+        else:
+            r.raise_for_status()
+            cache = {"url": url, "etag": r.headers.get("ETag"), "fetched_at": time.time(), "index": r.json()}
+    except (requests.RequestException, ValueError) as e:
+        if cache is None:
+            raise RuntimeError(f"Could not fetch the dailies index from {url}: {e}") from e
+        logger.warning("Could not fetch the dailies index from %s, using the cached one: %s", url, e)
+        return cache["index"]
+
+    _save_cache(cache_path, cache)
+    return cache["index"]
+
+
+def latest_workbench(platform: str = "bionic", **kwargs) -> Tuple[str, str]:
+    """
+    The download link and file name of the latest Workbench daily build.
+    Keyword arguments are passed on to `fetch_index`.
+    """
+    build = fetch_index(**kwargs)["products"]["workbench"]["platforms"][platform]
+    return build["link"], build["filename"]
@@ -0,0 +1 @@
+../rsw-ha/templates/timeline.py
\ No newline at end of file
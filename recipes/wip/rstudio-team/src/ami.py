@@ -0,0 +1,141 @@
+"""
+Golden AMIs with the slow install steps of a product baked in.
+
+An image is keyed by a hash of the files that define its install steps, so it
+is reused by any stack whose install scripts are unchanged. The first stack
+to need an image provisions its host as usual, takes the image once the bake
+steps are done and keeps it when the stack is destroyed.
+"""
+
+import hashlib
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import pulumi
+from pulumi_aws import ec2
+from pulumi_command import remote
+
+from .helpers import dep
+
+
+RECIPE_DIR = Path(__file__).resolve().parent.parent
+
+# The files each product's bake steps are built from.
+INSTALL_SOURCES = {
+    "rsw": ["src/apt.py", "src/dstools.py", "src/linux.py", "src/rsw.py", "templates/rsw/justfile"],
+    "rsc": ["src/apt.py", "src/dstools.py", "src/linux.py", "src/rsc.py", "templates/rsc/justfile"],
+    "rspm": ["src/apt.py", "src/dstools.py", "src/linux.py", "src/rspm.py", "templates/rspm/justfile"],
+}
+
+
+def install_hash(product: str, base_ami: str) -> str:
+    """
+    Hash of the base image and every file the product's install steps come from.
+    """
+    digest = hashlib.sha256(f"{product}\n{base_ami}\n".encode())
+    for source in INSTALL_SOURCES[product]:
+        digest.update(source.encode() + b"\n")
+        digest.update((RECIPE_DIR / source).read_bytes())
+    return digest.hexdigest()
+
+
+def find_image(product: str, content_hash: str) -> Optional[str]:
+    """
+    The first image baked for this hash by another stack, if there is one.
+    An image baked by this stack is still managed by it and is not reused.
+
+    This runs on every `pulumi up`. Taking the oldest image rather than the
+    newest keeps the choice pinned: another image baked later for the same hash
+    does not change the host's `ami` and replace it. Only deregistering the
+    image moves the stack to the next one.
+    """
+    ids = ec2.get_ami_ids(
+        owners=["self"],
+        filters=[
+            ec2.GetAmiIdsFilterArgs(name="tag:rs:product", values=[product]),
+            ec2.GetAmiIdsFilterArgs(name="tag:rs:install-hash", values=[content_hash]),
+        ],
+        sort_ascending=True,
+    ).ids
+    if not ids:
+        return None
+    image = ec2.get_ami(owners=["self"], filters=[ec2.GetAmiFilterArgs(name="image-id", values=[ids[0]])])
+    if (image.tags or {}).get("rs:stack") == _stack():
+        return None
+    return ids[0]
+
+
+def _stack() -> str:
+    return f"{pulumi.get_project()}/{pulumi.get_stack()}"
+
+
+class GoldenAmi:
+    """
+    Pick the image a product's host boots from and, when no image matches the
+    install scripts yet, bake one from the host.
+    """
+
+    def __init__(self, product: str, base_ami: str, enabled: bool = True):
+        self.product = product
+        self.base_ami = base_ami
+        self.enabled = enabled
+        self.install_hash = install_hash(product, base_ami)
+        self.image_id = find_image(product, self.install_hash) if enabled else None
+        if enabled:
+            pulumi.export(f"{product}_install_hash", self.install_hash)
+
+    @property
+    def baked(self) -> bool:
+        return self.image_id is not None
+
+    @property
+    def ami(self) -> str:
+        return self.image_id or self.base_ami
+
+    def sealer(
+        self,
+        server: ec2.Instance,
+        connection: remote.ConnectionArgs,
+        tags: Dict[str, str],
+        parent: Optional[pulumi.Resource] = None,
+    ) -> Optional[Callable[[List[pulumi.Resource]], pulumi.Resource]]:
+        """
+        The `seal` callback for a `StepGraph`, or None when nothing is baked.
+        """
+        if not self.enabled:
+            return None
+        if self.baked:
+            pulumi.export(f"{self.product}_golden_ami", self.image_id)
+            return None
+
+        def seal(bake_steps: List[pulumi.Resource]) -> pulumi.Resource:
+            cleanup = remote.Command(
+                f"{self.product}-bake-cleanup",
+                create="sudo rm -f /etc/apt/apt.conf.d/01proxy; sudo apt-get clean; sync",
+                connection=connection,
+                opts=dep(bake_steps, parent)
+            )
+            # Taken without a reboot so the remaining steps can carry on over
+            # the same connection, the `sync` above flushes the installs. The
+            # apt proxy belongs to this stack and is left out of the image.
+            image = ec2.AmiFromInstance(
+                f"{self.product}-golden-ami",
+                name=f"rs-{self.product}-{self.install_hash[:16]}-{pulumi.get_stack()}",
+                source_instance_id=server.id,
+                snapshot_without_reboot=True,
+                tags={
+                    **tags,
+                    "Name": f"rs-{self.product}-golden",
+                    "rs:product": self.product,
+                    "rs:install-hash": self.install_hash,
+                    "rs:stack": _stack(),
+                },
+                opts=pulumi.ResourceOptions.merge(
+                    dep([cleanup], parent),
+                    pulumi.ResourceOptions(retain_on_delete=True),
+                )
+            )
+            pulumi.export(f"{self.product}_golden_ami", image.id)
+            return image
+
+        return seal
@@ -0,0 +1,40 @@
+"""
+Install every apt package a host needs in a single step.
+
+Steps ask the host's `AptPlan` for the packages they use and list the returned
+values in their `needs`. The plan adds one step to the graph that enables the
+repositories, runs `apt-get update` once and installs all of the packages in
+one `apt-get install`, instead of each step refreshing apt on its own.
+"""
+
+from typing import List, Sequence
+
+from .graph import StepGraph
+
+
+class AptPlan:
+    def __init__(self, steps: StepGraph, prefix: str, repositories: Sequence[str] = ("main", "universe")):
+        self.name = f"{prefix}-apt-install"
+        self.repositories = list(repositories)
+        self.packages: List[str] = []
+        # Declared up front so it is the first step to take the dpkg lock.
+        steps.command(self.name, create=self.script(), locks=["dpkg"], bake=True)
+        self.step = steps.steps[self.name]
+
+    def require(self, *packages: str) -> List[str]:
+        """
+        Add packages to the plan and return the needs for a step using them.
+        """
+        for package in packages:
+            if package not in self.packages:
+                self.packages.append(package)
+                self.step.provides.append(f"apt:{package}")
+        self.step.args["create"] = self.script()
+        return [f"apt:{package}" for package in packages]
+
+    def script(self) -> str:
+        lines = [f"sudo add-apt-repository -y -n {repository};" for repository in self.repositories]
+        lines.append("sudo apt-get update;")
+        if self.packages:
+            lines.append(f"sudo DEBIAN_FRONTEND=noninteractive apt-get install -y {' '.join(self.packages)};")
+        return "\n".join(lines)
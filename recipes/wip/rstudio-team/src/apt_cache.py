@@ -0,0 +1,107 @@
+"""
+A shared apt-cacher-ng proxy, so the hosts download each Ubuntu package once.
+"""
+
+from textwrap import dedent
+from typing import Any
+
+import pulumi
+from pulumi_aws import ec2
+
+from .graph import StepGraph
+from .helpers import BaseConfig
+
+
+PORT = 3142
+
+
+def user_data_script() -> str:
+    """
+    Install apt-cacher-ng when the proxy first boots, together with an
+    `apt-cache-stats` command printing the cache hit rates as JSON. Every file
+    sent to a client is logged with "O", every file fetched from a mirror with "I".
+    """
+    script = """
+    #!/bin/bash
+    export DEBIAN_FRONTEND=noninteractive
+    echo "apt-cacher-ng apt-cacher-ng/tunnelenable boolean false" | debconf-set-selections
+    apt-get update
+    apt-get install -y apt-cacher-ng
+    systemctl enable --now apt-cacher-ng
+
+    cat > /usr/local/bin/apt-cache-stats <<'STATS'
+    #!/bin/bash
+    cat /var/log/apt-cacher-ng/apt-cacher.log 2>/dev/null | awk -F'|' '
+        $2 == "O" { requests += 1; served += $3 }
+        $2 == "I" { misses += 1; fetched += $3 }
+        END {
+            hits = requests > misses ? requests - misses : 0
+            saved = served > fetched ? served - fetched : 0
+            printf "{\\"requests\\": %.0f, \\"hits\\": %.0f, \\"bytes_served\\": %.0f, \\"bytes_fetched\\": %.0f, ", requests, hits, served, fetched
+            printf "\\"hit_rate\\": %.3f, \\"byte_hit_rate\\": %.3f}\\n", requests ? hits / requests : 0, served ? saved / served : 0
+        }'
+    STATS
+    chmod +x /usr/local/bin/apt-cache-stats
+    """
+    return dedent(script).strip()
+
+
+def proxy_script(proxy_ip: Any) -> pulumi.Output:
+    """
+    Point apt at the cache. apt asks `apt-proxy-detect` before every download,
+    so the host falls back to the mirrors whenever the cache is unreachable.
+    """
+    proxy = pulumi.Output.concat(proxy_ip, f"/{PORT}")
+    return pulumi.Output.concat(
+        "for i in $(seq 60); do timeout 2 bash -c '</dev/tcp/", proxy, "' 2>/dev/null && break; sleep 5; done;\n",
+        "printf '#!/bin/bash\\nif timeout 2 bash -c \"</dev/tcp/", proxy, "\" 2>/dev/null; ",
+        "then echo http://", proxy_ip, f":{PORT}; else echo DIRECT; fi\\n' | sudo tee /usr/local/bin/apt-proxy-detect > /dev/null;\n",
+        "sudo chmod +x /usr/local/bin/apt-proxy-detect;\n",
+        """echo 'Acquire::http::Proxy-Auto-Detect "/usr/local/bin/apt-proxy-detect";' | sudo tee /etc/apt/apt.conf.d/01proxy;""",
+    )
+
+
+def add_proxy_step(steps: StepGraph, prefix: str, config: BaseConfig) -> None:
+    """
+    Configure the proxy ahead of every other step holding the dpkg lock.
+    """
+    if config.apt_proxy is None:
+        return
+    steps.command(
+        f"{prefix}-apt-proxy",
+        create=proxy_script(config.apt_proxy),
+        provides=["apt-proxy"],
+        locks=["dpkg"],
+        bake=True,
+    )
+
+
+def make(config: BaseConfig) -> ec2.Instance:
+    vpc = ec2.get_vpc(default=True)
+    security_group = ec2.SecurityGroup(
+        "apt-cache-security-group",
+        description="Apt cache security group for Pulumi deployment",
+        ingress=[
+            {"protocol": "TCP", "from_port": 22, "to_port": 22, 'cidr_blocks': ['0.0.0.0/0'], "description": "SSH"},
+            {"protocol": "TCP", "from_port": PORT, "to_port": PORT, 'cidr_blocks': [vpc.cidr_block], "description": "APT-CACHER-NG"},
+        ],
+        egress=[
+            {"protocol": "All", "from_port": -1, "to_port": -1, 'cidr_blocks': ['0.0.0.0/0'], "description": "Allow all outbout traffic"},
+        ],
+        tags=config.tags
+    )
+    server = ec2.Instance(
+        "apt-cache",
+        instance_type="t3.small",
+        vpc_security_group_ids=[security_group.id],
+        ami=config.ami_id,
+        user_data=user_data_script(),
+        tags=config.tags,
+        key_name=config.key_pair.key_name
+    )
+
+    # Export final pulumi variables.
+    pulumi.export('apt_cache_public_dns', server.public_dns)
+    pulumi.export('apt_cache_report_url', pulumi.Output.concat("http://", server.private_ip, f":{PORT}/acng-report.html"))
+
+    return server
@@ -0,0 +1,64 @@
+"""
+Ship all of a host's config files in a single step.
+
+The files are packed into one gzipped tar, sent base64 encoded in the step's
+script and checked against their sha256 before anything is touched. They are
+unpacked into a staging directory next to the target and then renamed into
+place, so a failed transfer never leaves a half-applied config behind.
+"""
+
+import base64
+import gzip
+import hashlib
+import io
+import tarfile
+from pathlib import Path
+from textwrap import dedent
+from typing import Dict, List
+
+
+def pack(files: Dict[str, str]) -> bytes:
+    """
+    A gzipped tar of the files, keyed by their name in the target directory.
+    The archive only depends on the file contents, so an unchanged bundle
+    leaves the step unchanged.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w", format=tarfile.PAX_FORMAT) as archive:
+        for name in sorted(files):
+            data = files[name].encode("utf-8")
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = 0o644
+            archive.addfile(info, io.BytesIO(data))
+    return gzip.compress(buffer.getvalue(), mtime=0)
+
+
+def install_script(files: Dict[str, str], target: str) -> str:
+    """
+    Verify the bundle, unpack it next to `target` and move every file into place.
+    """
+    bundle = pack(files)
+    checksum = hashlib.sha256(bundle).hexdigest()
+    archive = f"/tmp/config-bundle-{checksum[:16]}.tar.gz"
+    moves = "\n".join(f'sudo mv -f "$staging/{name}" {target}/{name};' for name in sorted(files))
+    script = f"""
+    set -e;
+    echo '{base64.b64encode(bundle).decode("ascii")}' | base64 -d > {archive};
+    echo '{checksum}  {archive}' | sha256sum --check --quiet;
+    staging=$(sudo mktemp -d {target}/.config-bundle.XXXXXX);
+    sudo tar -xzf {archive} -C "$staging" --no-same-owner --touch;
+    """
+    cleanup = f"""
+    sudo rmdir "$staging";
+    rm -f {archive};
+    """
+    return "\n".join([dedent(script).strip(), moves, dedent(cleanup).strip()])
+
+
+def bundle_script(local_paths: List[str], target: str) -> str:
+    """
+    Install the local files into `target` on the host, keeping their names.
+    """
+    files = {Path(path).name: Path(path).read_text() for path in local_paths}
+    return install_script(files, target)
@@ -1,11 +1,19 @@
 from textwrap import dedent
 
 
-def install_r_script(r_version = "4.1.2", symlink=False) -> str:
+def download_r_script(r_version = "4.1.2") -> str:
     script = f"""
     curl -O https://cdn.rstudio.com/r/ubuntu-2004/pkgs/r-{r_version}_1_amd64.deb
+    """
+    return dedent(script).strip()
+
+
+def install_r_script(r_version = "4.1.2", symlink=False, download=True) -> str:
+    script = f"""
     sudo gdebi r-{r_version}_1_amd64.deb -n
     """
+    if download:
+        script = "\n".join([download_r_script(r_version), dedent(script).strip()])
     symlink_script = f"""
     sudo ln -s /opt/R/{r_version}/bin/R /usr/local/bin/R
     sudo ln -s /opt/R/{r_version}/bin/Rscript /usr/local/bin/Rscript
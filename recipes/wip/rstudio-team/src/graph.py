@@ -0,0 +1,290 @@
+"""
+Build the provisioning steps for a host as a dependency graph.
+
+Each step declares what it `needs` and what it `provides` (a package, a file,
+an installed product, ...). The graph works out which step produces each need
+and keeps only the fewest `depends_on` edges required to respect them, so
+independent steps run at the same time. Steps that share a `lock` (e.g. the
+dpkg lock) are additionally run one after another in declaration order.
+
+Steps marked `bake` install software that can be baked into a golden AMI
+(see `ami.py`). When the host boots from such an image the bake steps are
+skipped; when the host is the one being baked, every other step waits until
+the image has been taken so that users, config and licenses stay out of it.
+
+`build` creates a resource per step. `build_session` instead runs all of a
+host's steps over one SSH session with the step runner in `runner.py`.
+"""
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+import pulumi
+from pulumi_command import remote
+
+from .helpers import content_hash, dep
+from .runner import PlanStep, runner_script
+
+
+HOST = "host"
+
+
+@dataclass
+class Step:
+    name: str
+    kind: str
+    args: Dict[str, Any]
+    needs: List[str] = field(default_factory=list)
+    provides: List[str] = field(default_factory=list)
+    locks: List[str] = field(default_factory=list)
+    bake: bool = False
+
+
+class StepGraph:
+    """
+    Collect the steps for one host and create them with minimal dependencies.
+
+    Every step implicitly needs `HOST`, which is provided by `root` (usually the
+    ec2 instance or a resource that gates on it being reachable).
+
+    `baked` means the host booted from an image that already contains the bake
+    steps. `seal` is called with the bake step resources and returns the
+    resource (usually the image) the remaining steps have to wait for.
+    The step resources are created as children of `parent` when one is given.
+    """
+
+    def __init__(
+        self,
+        root: pulumi.Resource,
+        baked: bool = False,
+        seal: Optional[Callable[[List[pulumi.Resource]], pulumi.Resource]] = None,
+        parent: Optional[pulumi.Resource] = None,
+    ):
+        self.root = root
+        self.baked = baked
+        self.seal = seal
+        self.parent = parent
+        self.steps: Dict[str, Step] = {}
+
+    def command(
+        self,
+        name: str,
+        create: Any,
+        needs: Optional[List[str]] = None,
+        provides: Optional[List[str]] = None,
+        locks: Optional[List[str]] = None,
+        bake: bool = False,
+    ) -> None:
+        self._add(Step(name, "command", {"create": create}, needs or [], provides or [], locks or [], bake))
+
+    def copy_file(
+        self,
+        name: str,
+        local_path: str,
+        remote_path: str,
+        needs: Optional[List[str]] = None,
+        provides: Optional[List[str]] = None,
+        bake: bool = False,
+    ) -> None:
+        # Copy again whenever the file changes, not only when its path does.
+        triggers = [content_hash(Path(local_path).read_text())]
+        args = {"local_path": local_path, "remote_path": remote_path, "triggers": triggers}
+        self._add(Step(name, "copy_file", args, needs or [], provides or [remote_path], bake=bake))
+
+    def _add(self, step: Step) -> None:
+        if step.name in self.steps:
+            raise ValueError(f"Step {step.name!r} is declared twice")
+        self.steps[step.name] = step
+
+    def producers(self) -> Dict[str, str]:
+        """
+        Map every provided value to the step that provides it.
+        """
+        producers = {}
+        for step in self.steps.values():
+            for value in step.provides:
+                if value in producers:
+                    raise ValueError(
+                        f"{value!r} is provided by both {producers[value]!r} and {step.name!r}"
+                    )
+                producers[value] = step.name
+        return producers
+
+    def requirements(self) -> Dict[str, Set[str]]:
+        """
+        The steps each step has to wait for, before removing redundant edges.
+        """
+        producers = self.producers()
+        edges: Dict[str, Set[str]] = {name: set() for name in self.steps}
+        for step in self.steps.values():
+            for need in step.needs:
+                if need == HOST:
+                    continue
+                if need not in producers:
+                    raise ValueError(f"Step {step.name!r} needs {need!r} but no step provides it")
+                producer = producers[need]
+                if step.bake and not self.steps[producer].bake:
+                    raise ValueError(f"Bake step {step.name!r} needs {need!r} from step {producer!r} which is not baked")
+                edges[step.name].add(producer)
+
+        # Steps holding the same lock run in the order they were declared.
+        holders: Dict[str, str] = {}
+        for step in self.steps.values():
+            for lock in step.locks:
+                if lock in holders:
+                    edges[step.name].add(holders[lock])
+                holders[lock] = step.name
+        return edges
+
+    def order(self) -> List[str]:
+        """
+        Topological order of the steps, stable with respect to declaration order.
+        """
+        edges = self.requirements()
+        done: List[str] = []
+        visiting: Set[str] = set()
+
+        def visit(name: str) -> None:
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Dependency cycle through step {name!r}")
+            visiting.add(name)
+            for upstream in sorted(edges[name], key=list(self.steps).index):
+                visit(upstream)
+            visiting.discard(name)
+            done.append(name)
+
+        for name in self.steps:
+            visit(name)
+        return done
+
+    def edges(self) -> Dict[str, List[str]]:
+        """
+        The transitive reduction of `requirements()`: the fewest edges that
+        still order every step after everything it needs.
+        """
+        requirements = self.requirements()
+        order = self.order()
+        ancestors: Dict[str, Set[str]] = {}
+        for name in order:
+            ancestors[name] = set()
+            for upstream in requirements[name]:
+                ancestors[name] |= {upstream} | ancestors[upstream]
+
+        reduced = {}
+        for name, upstreams in requirements.items():
+            # Drop an edge when another upstream step already waits on it.
+            implied = set()
+            for upstream in upstreams:
+                implied |= ancestors[upstream]
+            reduced[name] = [u for u in order if u in upstreams and u not in implied]
+        return reduced
+
+    def build(self, connection: remote.ConnectionArgs) -> Dict[str, pulumi.Resource]:
+        """
+        Create the pulumi resources for every step.
+
+        Each step is triggered by the ids of the steps providing its needs. A
+        step that is replaced because its script or file changed therefore
+        re-runs everything downstream of it (copy, move, restart) and nothing
+        else. Lock-only ordering does not propagate changes.
+        """
+        edges = self.edges()
+        order = self.order()
+        producers = self.producers()
+        resources: Dict[str, pulumi.Resource] = {}
+
+        def create(name: str, resolve: Callable[[str], pulumi.Resource], fallback: pulumi.Resource) -> None:
+            step = self.steps[name]
+            upstream = _unique(resolve(u) for u in edges[name]) or [fallback]
+            needed = _unique(resolve(producers[need]) for need in step.needs if need != HOST)
+            triggers = list(step.args.get("triggers", [])) + [r.id for r in needed if r is not self.root]
+            args = {**step.args, "triggers": triggers}
+            if step.kind == "command":
+                resources[name] = remote.Command(name, connection=connection, opts=dep(upstream, self.parent), **args)
+            else:
+                resources[name] = remote.CopyFile(name, connection=connection, opts=dep(upstream, self.parent), **args)
+
+        baking = self.seal is not None and not self.baked
+        bake_steps = [name for name in order if self.steps[name].bake]
+        if not self.baked:
+            for name in bake_steps:
+                create(name, lambda u: resources[u], self.root)
+
+        # What the other steps wait for in place of a bake step.
+        image_ready = self.root
+        if baking and bake_steps:
+            image_ready = self.seal([resources[name] for name in bake_steps])
+
+        def resolve(u: str) -> pulumi.Resource:
+            if u in resources and not (baking and self.steps[u].bake):
+                return resources[u]
+            return image_ready
+
+        for name in order:
+            if not self.steps[name].bake:
+                create(name, resolve, image_ready)
+        return resources
+
+    def build_session(self, connection: remote.ConnectionArgs, prefix: str) -> Dict[str, pulumi.Resource]:
+        """
+        Create the steps as a single command that runs all of them over one
+        SSH session (see `runner.py`), instead of a resource per step. When the
+        host is being baked the bake steps get a session of their own, taken
+        before the image. Returns the session command running each step.
+        """
+        order = self.order()
+        requirements = self.requirements()
+        producers = self.producers()
+        resources: Dict[str, pulumi.Resource] = {}
+
+        def session(name: str, names: List[str], upstream: List[pulumi.Resource]) -> pulumi.Resource:
+            def plan(scripts: List[str]) -> Tuple[str, str]:
+                steps = []
+                for step_name, script in zip(names, scripts):
+                    step = self.steps[step_name]
+                    after = [u for u in names if u in requirements[step_name]]
+                    needs = [u for u in names if u in {producers[n] for n in step.needs if n != HOST}]
+                    if step.kind == "command":
+                        steps.append(PlanStep(step_name, "command", script=script, after=after, needs=needs))
+                    else:
+                        content = Path(step.args["local_path"]).read_text()
+                        steps.append(PlanStep(step_name, "copy", content=content, remote_path=step.args["remote_path"], after=after, needs=needs))
+                return runner_script(steps)
+
+            scripts = [self.steps[n].args.get("create", "") for n in names]
+            # The plan goes on stdin, it holds secrets the command line would show.
+            command_and_plan = pulumi.Output.all(*scripts).apply(plan)
+            command = remote.Command(
+                name,
+                create=command_and_plan.apply(lambda x: x[0]),
+                stdin=command_and_plan.apply(lambda x: x[1]),
+                connection=connection,
+                opts=dep(upstream, self.parent)
+            )
+            for step_name in names:
+                resources[step_name] = command
+            return command
+
+        bake_steps = [name for name in order if self.steps[name].bake]
+        rest = [name for name in order if not self.steps[name].bake]
+        if self.baked:
+            if rest:
+                session(f"{prefix}-session", rest, [self.root])
+        elif self.seal is not None and bake_steps:
+            image_ready = self.seal([session(f"{prefix}-bake-session", bake_steps, [self.root])])
+            if rest:
+                session(f"{prefix}-session", rest, [image_ready])
+        elif order:
+            session(f"{prefix}-session", order, [self.root])
+        return resources
+
+
+def _unique(resources: Iterable[pulumi.Resource]) -> List[pulumi.Resource]:
+    unique: List[pulumi.Resource] = []
+    for resource in resources:
+        if resource not in unique:
+            unique.append(resource)
+    return unique
@@ -1,14 +1,17 @@
 import os
 from dataclasses import dataclass, field
 from textwrap import dedent
-from typing import Any, Dict, List, Optional, Tuple
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple
 
 import pulumi
 from pulumi_aws import ec2
-from pulumi_tls import PrivateKey
-from rich import inspect, print
 
 import base64
+import hashlib
+import json
+
+if TYPE_CHECKING:
+    from pulumi_tls import PrivateKey
 
 @dataclass
 class BaseConfig:
@@ -20,9 +23,12 @@ class BaseConfig:
             "rs:owner": "sam.edwardes@rstudio.com",
             "rs:project": "solutions",
     })
-    key: Optional[PrivateKey] = None
+    key: Optional["PrivateKey"] = None
     key_pair: Optional[ec2.KeyPair] = None
     private_key: Optional[Any] = None
+    golden_ami: bool = False
+    apt_proxy: Optional[Any] = None
+    single_session: bool = False
 
 
 def decode_key(key):
@@ -39,8 +45,26 @@ def decode_key(key):
     return key.encode('ascii')
     
 
-def dep(dependencies: List[Any]):
+def under(parent: Optional[pulumi.Resource]) -> pulumi.ResourceOptions:
+    """
+    Options for a resource created inside the component `parent`. The alias
+    keeps the state of resources created before they moved into a component.
+    """
+    if parent is None:
+        return pulumi.ResourceOptions()
+    return pulumi.ResourceOptions(parent=parent, aliases=[pulumi.Alias(parent=pulumi.ROOT_STACK_RESOURCE)])
+
+
+def dep(dependencies: List[Any], parent: Optional[pulumi.Resource] = None):
     """
     Helper function to define dependencies
     """
-    return pulumi.ResourceOptions(depends_on=dependencies)
\ No newline at end of file
+    return pulumi.ResourceOptions.merge(under(parent), pulumi.ResourceOptions(depends_on=dependencies))
+
+
+def content_hash(content: str, **variables) -> str:
+    """
+    Helper function to hash content and its variables for a trigger
+    """
+    payload = json.dumps(variables, sort_keys=True, default=str) + "\n" + content
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
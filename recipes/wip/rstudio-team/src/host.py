@@ -0,0 +1,183 @@
+"""
+Stand up a host for one product and provision it.
+
+Provisioning is gated on the freshly started host being ready to use (SSH up,
+cloud-init done). `RStudioHost` does the bootstrap every product shares once
+and runs the product's own stages through a `StepGraph`.
+"""
+
+from dataclasses import dataclass, field
+from textwrap import dedent
+from typing import Any, Dict, List, Optional
+
+import pulumi
+from pulumi_aws import ec2
+from pulumi_command import local, remote
+
+from . import apt_cache
+from . import linux
+from .ami import GoldenAmi
+from .apt import AptPlan
+from .graph import StepGraph
+from .helpers import BaseConfig, dep, under
+from .runner import parse_results
+
+
+def wait_for_ssh_script(timeout: int = 600) -> str:
+    """
+    Python run on the machine running pulumi. Waits, with exponential backoff,
+    until the host in $HOST answers on port 22 with an SSH banner and prints
+    the number of seconds it waited.
+    """
+    script = f"""
+    import os, socket, sys, time
+    host = os.environ["HOST"]
+    start = time.monotonic()
+    delay = 1
+    while True:
+        try:
+            with socket.create_connection((host, 22), timeout=5) as s:
+                if s.recv(4).startswith(b"SSH-"):
+                    break
+        except OSError:
+            pass
+        if time.monotonic() - start > {timeout}:
+            sys.exit(f"Timed out after {timeout}s waiting for SSH on {{host}}")
+        time.sleep(delay)
+        delay = min(delay * 2, 30)
+    print(round(time.monotonic() - start, 1))
+    """
+    return dedent(script).strip()
+
+
+def _seconds(stdout: str) -> Optional[float]:
+    return float(stdout) if stdout.strip() else None
+
+
+def make_ready_gate(
+    prefix: str,
+    server: ec2.Instance,
+    connection: remote.ConnectionArgs,
+    parent: Optional[pulumi.Resource] = None,
+) -> remote.Command:
+    """
+    Wait for SSH and then for cloud-init to finish (so it no longer holds the
+    apt locks). Every provisioning step on the host should depend on the
+    returned resource. The time spent waiting is exported per host.
+    """
+    ssh_ready = local.Command(
+        f"{prefix}-ssh-ready",
+        create=wait_for_ssh_script(),
+        interpreter=["python3", "-c"],
+        environment={"HOST": server.public_dns},
+        opts=dep([server], parent)
+    )
+    host_ready = remote.Command(
+        f"{prefix}-host-ready",
+        create=linux.wait_for_cloud_init_script(),
+        connection=connection,
+        opts=dep([ssh_ready], parent)
+    )
+    pulumi.export(f"{prefix}_ssh_wait_seconds", ssh_ready.stdout.apply(_seconds))
+    pulumi.export(f"{prefix}_cloud_init_wait_seconds", host_ready.stdout.apply(_seconds))
+    return host_ready
+
+
+def _step_results(stdouts: List[str]) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    for stdout in stdouts:
+        for name, result in parse_results(stdout).items():
+            results[name] = {"status": result.status, "exit_code": result.exit_code, "seconds": result.seconds}
+    return results
+
+
+@dataclass
+class Stage:
+    """
+    One provisioning stage of an `RStudioHost`. A stage runs `create`, or with
+    `local_path` copies a file to `remote_path`. `apt` lists the apt packages it
+    uses, they are installed by the host's single apt step before it runs. See
+    `StepGraph` for `needs`, `provides`, `locks` and `bake`.
+    """
+    name: str
+    create: Any = None
+    local_path: Optional[str] = None
+    remote_path: Optional[str] = None
+    needs: List[str] = field(default_factory=list)
+    provides: List[str] = field(default_factory=list)
+    locks: List[str] = field(default_factory=list)
+    apt: List[str] = field(default_factory=list)
+    bake: bool = False
+
+
+class RStudioHost(pulumi.ComponentResource):
+    """
+    An ec2 instance for one product, provisioned by a list of stages.
+
+    The bootstrap is the same for every product: the instance (booted from the
+    product's golden AMI when there is one), the ready gate, the apt proxy, a
+    single apt install for the packages of all stages and the shell tools. The
+    stages are wired by what they need and provide, so independent stages run
+    at the same time. `stages` maps each stage name, bootstrap steps included,
+    to its resource. With `config.single_session` all stages run over one SSH
+    session and the result of each is exported as `<product>_step_results`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        product: str,
+        config: BaseConfig,
+        stages: List[Stage],
+        opts: Optional[pulumi.ResourceOptions] = None,
+    ):
+        super().__init__("rstudio:index:RStudioHost", name, None, opts)
+        image = GoldenAmi(product, config.ami_id, enabled=config.golden_ami)
+
+        self.server = ec2.Instance(
+            name,
+            instance_type=config.ec2_size,
+            vpc_security_group_ids=config.vpc_group_ids,
+            ami=image.ami,
+            tags=config.tags,
+            key_name=config.key_pair.key_name,
+            opts=under(self)
+        )
+        self.connection = remote.ConnectionArgs(
+            host=self.server.public_dns,
+            user="ubuntu",
+            private_key=config.private_key
+        )
+
+        steps = StepGraph(
+            root=make_ready_gate(product, self.server, self.connection, parent=self),
+            baked=image.baked,
+            seal=image.sealer(self.server, self.connection, config.tags, parent=self),
+            parent=self,
+        )
+        apt_cache.add_proxy_step(steps, product, config)
+        apt = AptPlan(steps, product)
+        steps.command(
+            f"{product}-configure-tools",
+            create=linux.configure_tools_script(),
+            needs=apt.require(*linux.TOOLS_PACKAGES),
+            bake=True,
+        )
+        for stage in stages:
+            needs = apt.require(*stage.apt) + stage.needs
+            if stage.local_path is not None:
+                steps.copy_file(stage.name, stage.local_path, stage.remote_path, needs=needs, provides=stage.provides or None, bake=stage.bake)
+            else:
+                steps.command(stage.name, create=stage.create, needs=needs, provides=stage.provides, locks=stage.locks, bake=stage.bake)
+
+        if config.single_session:
+            self.stages: Dict[str, pulumi.Resource] = steps.build_session(self.connection, product)
+            sessions = list(dict.fromkeys(self.stages.values()))
+            pulumi.export(f"{product}_step_results", pulumi.Output.all(*[s.stdout for s in sessions]).apply(_step_results))
+        else:
+            self.stages = steps.build(self.connection)
+        self.register_outputs({
+            "public_ip": self.server.public_ip,
+            "public_dns": self.server.public_dns,
+            "stages": {name: resource.id for name, resource in self.stages.items()},
+        })
@@ -41,6 +41,17 @@ def apt_get_init_script() -> str:
     return dedent(script).strip()
 
 
+# Helpful unix tools for working on the server.
+TOOLS_PACKAGES = ["tree", "bat"]
+
+
+def configure_tools_script() -> str:
+    script = """
+    echo "alias bat='batcat --paging never'" >> ~/.bashrc;
+    """
+    return dedent(script).strip()
+
+
 def install_gbebi_core_script() -> str:
     script = """
     sudo add-apt-repository main;
@@ -59,5 +70,55 @@ def add_user_script(user_name: str, password: str = "password") -> str:
     return dedent(script).strip()
 
 
+def wait_until_script(check: str, description: str, timeout: int = 120) -> str:
+    """
+    Re-run the shell `check` until it succeeds, backing off from 1 up to 10
+    seconds between tries. Fails with a clear message after `timeout` seconds.
+    """
+    script = f"""
+    deadline=$(( $(date +%s) + {timeout} ));
+    delay=1;
+    until {check}; do
+        if [ $(date +%s) -ge $deadline ]; then
+            echo "Timed out after {timeout}s waiting for {description}" >&2;
+            exit 1;
+        fi;
+        sleep $delay;
+        delay=$(( delay * 2 > 10 ? 10 : delay * 2 ));
+    done;
+    echo "{description} is ready";
+    """
+    return dedent(script).strip()
 
 
+def wait_for_url_script(url: str, timeout: int = 120) -> str:
+    """
+    Wait until `url` answers with a successful HTTP status.
+    """
+    return wait_until_script(f"curl -fs -o /dev/null {url}", url, timeout)
+
+
+def wait_for_port_script(port: int, host: str = "127.0.0.1", timeout: int = 120) -> str:
+    """
+    Wait until something accepts TCP connections on `host:port`.
+    """
+    check = f"timeout 2 bash -c '</dev/tcp/{host}/{port}' 2>/dev/null"
+    return wait_until_script(check, f"{host}:{port}", timeout)
+
+
+def wait_for_cloud_init_script() -> str:
+    """
+    Block until cloud-init has finished and print how many seconds that took.
+    Exit code 2 means cloud-init finished with recoverable errors.
+    """
+    script = """
+    start=$(date +%s);
+    sudo cloud-init status --wait > /dev/null;
+    status=$?;
+    if [ $status -ne 0 ] && [ $status -ne 2 ]; then
+        sudo cloud-init status --long >&2;
+        exit 1;
+    fi;
+    echo $(( $(date +%s) - start ));
+    """
+    return dedent(script).strip()
@@ -6,152 +6,106 @@ from typing import Any, Dict, List, Optional, Tuple
 import pulumi
 from pulumi_aws import ec2
 from pulumi_command import remote
-from pulumi_tls import PrivateKey
-from rich import inspect, print
 
 from . import dstools
 from . import linux
 
 from .helpers import BaseConfig, dep
+from .host import RStudioHost, Stage
+
+
+PING_URL = "http://localhost:4242/__ping__"
 
 
 def make(config: BaseConfig):    
-    # Stand up a server.
-    server = ec2.Instance(
-        "rstudio-package-manager",
-        instance_type=config.ec2_size,
-        vpc_security_group_ids=config.vpc_group_ids,
-        ami=config.ami_id,
-        tags=config.tags,
-        key_name=config.key_pair.key_name
-    )
+    stages = [
+        # ----------------------------------------------------------------------
+        # Install prequisits.
+        # ----------------------------------------------------------------------
+        Stage("rspm-add-user-sam", create=linux.add_user_script("sam"), provides=["user:sam"]),
+        Stage("rspm-install-tools", create=install_prerequisites_script(), provides=["just"], bake=True),
+
+        # ----------------------------------------------------------------------
+        # Install and activate RSPM.
+        # ----------------------------------------------------------------------
+        Stage(
+            "rspm-install-r-412", 
+            create=dstools.install_r_script("4.1.2"), 
+            apt=["gdebi-core"],
+            provides=["r-4.1.2"],
+            locks=["dpkg"],
+            bake=True,
+        ),
+        Stage("rspm-download-package-manager", create=download_script(), provides=["package-manager.deb"], bake=True),
+        Stage(
+            "rspm-install-package-manager", 
+            create=install_script(download=False), 
+            apt=["gdebi-core"],
+            needs=["package-manager.deb", "r-4.1.2"],
+            provides=["package-manager"],
+            locks=["dpkg"],
+            bake=True,
+        ),
+        Stage(
+            "rspm-activate-license", 
+            create=activate_license_script(os.getenv("RSPM_LICENSE")), 
+            needs=["package-manager"],
+            provides=["package-manager-license"],
+        ),
+        Stage("rspm-set-admin", create=set_admin_script("sam"), needs=["package-manager", "user:sam"], provides=["admin:sam"]),
+        Stage("rspm-restart", create=restart_script(), needs=["package-manager-license", "admin:sam"], provides=["rspm-running"]),
+
+        # ----------------------------------------------------------------------
+        # Copy config files
+        # ----------------------------------------------------------------------
+        Stage("rswpm-justfile", local_path="templates/rspm/justfile", remote_path="justfile"),
+
+        # ----------------------------------------------------------------------
+        # Serve repos.
+        # ----------------------------------------------------------------------
+        Stage("rspm-serve-cran", create=serve_cran_script(), needs=["rspm-running"], provides=["repo:prod-cran"]),
+        Stage("rspm-serve-curated-cran", create=serve_curated_cran_script(), needs=["repo:prod-cran"]),
+        # Stage("rspm-serve-pypi", create=serve_pypi_script(), needs=["rspm-running"]),
+    ]
+    host = RStudioHost("rstudio-package-manager", "rspm", config, stages)
 
     # Export final pulumi variables.
-    pulumi.export('package_manager_public_ip', server.public_ip)
-    pulumi.export('package_manager_public_dns', server.public_dns)
-    
-    # Create a connection to the server
-    connection = remote.ConnectionArgs(
-        host=server.public_dns, 
-        user="ubuntu", 
-        private_key=config.private_key
-    )
-    
-    # --------------------------------------------------------------------------
-    # Install prequisits.
-    # --------------------------------------------------------------------------
-    _sleep = remote.Command(
-        "rspm-sleep", 
-        create="sleep 5;", 
-        connection=connection, 
-        opts=dep([server])
-    )
-
-    _add_user = remote.Command(
-        "rspm-add-user-sam", 
-        create=linux.add_user_script("sam"), 
-        connection=connection, 
-        opts=dep([_sleep])
-    )
-
-    _apt_install = remote.Command(
-        "rspm-apt-init", 
-        create=install_prerequisites_script(), 
-        connection=connection, 
-        opts=dep([_add_user])
-    )
-
-    c_gdebi = remote.Command(
-        "rspm-install-gdebi-core", 
-        create=linux.install_gbebi_core_script(), 
-        connection=connection, 
-        opts=dep([_apt_install])
-    )
-    
-    # --------------------------------------------------------------------------
-    # Install and activate RSPM.
-    # --------------------------------------------------------------------------
-    c_install_r = remote.Command(
-        "rspm-install-r-412", 
-        create=dstools.install_r_script("4.1.2"), 
-        connection=connection, 
-        opts=dep([c_gdebi])
-    )
-    c_install_rspm = remote.Command(
-        "rspm-install-package-manager", 
-        create=install_script(os.getenv("RSPM_LICENSE")), 
-        connection=connection, opts=dep([c_install_r])
-    )
-    c_set_admin = remote.Command(
-        "rspm-set-admin", 
-        create=set_admin_script("sam"), 
-        connection=connection, 
-        opts=dep([c_install_rspm])
-    )
-    c_restart = remote.Command(
-        "rspm-restart", 
-        create=restart_script(), 
-        connection=connection,
-        opts=dep([c_set_admin])
-    )
-    
-    # --------------------------------------------------------------------------
-    # Copy config files
-    # --------------------------------------------------------------------------
-    _c_conf_1 = remote.CopyFile(
-        "rswpm-justfile", 
-        local_path="templates/rspm/justfile", 
-        remote_path="justfile", 
-        connection=connection, 
-        opts=dep([server])
-    )
-
-    # --------------------------------------------------------------------------
-    # Serve repos.
-    # --------------------------------------------------------------------------
-    c_serve_cran = remote.Command(
-        "rspm-serve-cran", 
-        create=serve_cran_script(), 
-        connection=connection, 
-        opts=dep([c_restart])
-    )
-
-    _ = remote.Command(
-        "rspm-serve-curated-cran", 
-        create=serve_curated_cran_script(), 
-        connection=connection, 
-        opts=dep([c_serve_cran])
-    )
-
-    # _ = remote.Command(
-    #     "rspm-serve-pypi", 
-    #     create=serve_pypi_script(), 
-    #     connection=connection, 
-    #     opts=dep([c_restart])
-    # )
-
-    return server
-
-
-def install_script(license_key: str) -> str:
-    script = f"""
+    pulumi.export('package_manager_public_ip', host.server.public_ip)
+    pulumi.export('package_manager_public_dns', host.server.public_dns)
+
+    return host.server
+
+
+def download_script() -> str:
+    script = """
     curl -O https://cdn.rstudio.com/package-manager/ubuntu20/amd64/rstudio-pm_2021.12.0-3_amd64.deb
-    sudo gdebi rstudio-pm_2021.12.0-3_amd64.deb -n
-    sudo /opt/rstudio-pm/bin/license-manager activate {license_key}
     """
     return dedent(script).strip()
 
 
-def restart_script() -> str:
+def install_script(download: bool = True) -> str:
     script = """
-    sudo systemctl stop rstudio-pm
-    sleep 5
-    sudo systemctl start rstudio-pm
-    sleep 5
+    sudo gdebi rstudio-pm_2021.12.0-3_amd64.deb -n
+    """
+    if download:
+        return "\n".join([download_script(), dedent(script).strip()])
+    return dedent(script).strip()
+
+
+def activate_license_script(license_key: str) -> str:
+    script = f"""
+    sudo /opt/rstudio-pm/bin/license-manager activate {license_key}
     """
     return dedent(script).strip()
 
 
+def restart_script() -> str:
+    return "\n".join([
+        "sudo systemctl restart rstudio-pm",
+        linux.wait_for_url_script(PING_URL),
+    ])
+
+
 def create_template_dir_script() -> str:
     script = """
     mkdir ~/rstudio_templates
@@ -219,10 +173,6 @@ def install_prerequisites_script() -> str:
     https://docs.rstudio.com/rspm/admin/getting-started/configuration/#quickstart-pypi-packages
     """
     script = f"""   
-    sudo apt-get update; 
-    # Install helpful unix tools
-    sudo apt-get -y install tree bat;
-    echo "alias bat='batcat --paging never'" >> ~/.bashrc
     # Install just
     curl --proto '=https' --tlsv1.2 -sSf https://just.systems/install.sh | bash -s -- --to ~/bin;
     echo 'export PATH="$PATH:$HOME/bin"' >> ~/.bashrc;
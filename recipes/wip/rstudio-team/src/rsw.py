@@ -1,10 +1,25 @@
 from textwrap import dedent
 
-def install_script() -> str:
+from .linux import wait_for_port_script, wait_for_url_script
+
+# Requires `server-health-check-enabled=1` in rserver.conf.
+HEALTH_CHECK_URL = "http://localhost:8787/health-check"
+WWW_PORT = 8787
+LAUNCHER_PORT = 5559
+
+def download_script() -> str:
     script = f"""
     curl -O https://download2.rstudio.org/server/bionic/amd64/rstudio-workbench-2022.02.0-443.pro2-amd64.deb;
+    """
+    return dedent(script).strip()
+
+
+def install_script(download: bool = True) -> str:
+    script = f"""
     sudo gdebi rstudio-workbench-2022.02.0-443.pro2-amd64.deb -n;
     """
+    if download:
+        return "\n".join([download_script(), dedent(script).strip()])
     return dedent(script).strip()
 
 
@@ -33,22 +48,22 @@ def move_config_files_script() -> str:
 
 
 def restart_script() -> str:
-    script = """
-    sudo rstudio-server restart;
-    sleep 5;
-    sudo rstudio-launcher restart;
-    sleep 5;
-    """
-    return dedent(script).strip()
+    return "\n".join([
+        "sudo rstudio-server restart;",
+        wait_for_url_script(HEALTH_CHECK_URL),
+        "sudo rstudio-launcher restart;",
+        wait_for_port_script(LAUNCHER_PORT),
+    ])
 
 
 def install_vscode_script() -> str:
-    script = """
-    sudo rstudio-server install-vs-code /opt/code-server;
-    sudo rstudio-server restart;
-    sudo rstudio-server install-vs-code-ext -d /opt/code-server;
-    """
-    return dedent(script).strip()
+    # Runs before the config bundle may have enabled the health check.
+    return "\n".join([
+        "sudo rstudio-server install-vs-code /opt/code-server;",
+        "sudo rstudio-server restart;",
+        wait_for_port_script(WWW_PORT),
+        "sudo rstudio-server install-vs-code-ext -d /opt/code-server;",
+    ])
 
 
 
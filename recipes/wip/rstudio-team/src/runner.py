@@ -0,0 +1,185 @@
+"""
+Run a host's whole step plan over a single SSH session.
+
+`runner_script` turns an ordered plan into one shell command and the plan to
+send on its stdin. The plan holds the step scripts, license keys and passwords
+included, so it never goes on a command line where `ps` would show it. The
+command starts a small Python runner on the host that runs each step as soon
+as the steps it comes after have finished, several at a time. Every finished
+step is reported on stdout between markers:
+
+    ::step-begin <name>
+    <output of the step>
+    ::step-end <name> <ok|failed|skipped|blocked> <exit code> <seconds>
+
+`parse_results` reads them back. A step that succeeds leaves its hash in
+`~/.step-runner` and is skipped on the next run while its hash is unchanged,
+so re-running the plan only runs changed steps and the steps that need them.
+
+The module has no pulumi imports, so the runner can be tried against any host
+(or a local sshd container) with
+
+    python runner.py plan.json --plan | ssh host "$(python runner.py plan.json)"
+"""
+
+import base64
+import hashlib
+import json
+import sys
+from dataclasses import asdict, dataclass, field
+from textwrap import dedent
+from typing import Dict, List, Optional, Tuple
+
+STATE_DIR = "~/.step-runner"
+MAX_WORKERS = 8
+
+
+@dataclass
+class PlanStep:
+    """
+    One step of the plan. A "command" runs `script` with bash, a "copy" writes
+    `content` to `remote_path`. `after` lists the steps it has to wait for,
+    `needs` the steps whose changes it has to re-run for.
+    """
+    name: str
+    kind: str
+    script: str = ""
+    content: str = ""
+    remote_path: str = ""
+    after: List[str] = field(default_factory=list)
+    needs: List[str] = field(default_factory=list)
+    hash: str = ""
+
+
+@dataclass
+class StepResult:
+    name: str
+    status: str
+    exit_code: int
+    seconds: float
+    output: str
+
+
+RUNNER = """
+import concurrent.futures, hashlib, json, os, subprocess, sys, time
+
+plan_text = sys.stdin.read()
+if hashlib.sha256(plan_text.encode("utf-8")).hexdigest() != sys.argv[1]:
+    sys.exit("The plan on stdin is incomplete or not the one this command was made for")
+plan = json.loads(plan_text)
+state = os.path.expanduser(sys.argv[2])
+os.makedirs(state, exist_ok=True)
+
+
+def run(step):
+    marker = os.path.join(state, step["name"])
+    if os.path.exists(marker) and open(marker).read() == step["hash"]:
+        return "skipped", 0, 0.0, ""
+    start = time.monotonic()
+    if step["kind"] == "copy":
+        path = os.path.expanduser(step["remote_path"])
+        with open(path, "w") as f:
+            f.write(step["content"])
+        code, output = 0, ""
+    else:
+        p = subprocess.run(["bash", "-c", step["script"]], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        code, output = p.returncode, p.stdout.decode("utf-8", "replace")
+    if code == 0:
+        with open(marker, "w") as f:
+            f.write(step["hash"])
+    return "ok" if code == 0 else "failed", code, time.monotonic() - start, output
+
+
+def report(name, status, code, seconds, output):
+    print(f"::step-begin {name}")
+    if output:
+        print(output.rstrip("\\n"))
+    print(f"::step-end {name} {status} {code} {seconds:.1f}", flush=True)
+
+
+status = {}
+running = {}
+with concurrent.futures.ThreadPoolExecutor(max_workers=int(sys.argv[3])) as pool:
+    while True:
+        failed = any(s == "failed" for s in status.values())
+        for step in plan:
+            name = step["name"]
+            if name in status or name in running:
+                continue
+            if any(status.get(u) in ("failed", "blocked") for u in step["after"]):
+                status[name] = "blocked"
+                report(name, "blocked", -1, 0.0, "")
+            elif not failed and all(status.get(u) in ("ok", "skipped") for u in step["after"]):
+                running[name] = pool.submit(run, step)
+        if not running:
+            break
+        done, _ = concurrent.futures.wait(running.values(), return_when=concurrent.futures.FIRST_COMPLETED)
+        for name, future in list(running.items()):
+            if future in done:
+                del running[name]
+                result = future.result()
+                status[name] = result[0]
+                report(name, *result)
+
+# Steps not started because another one failed.
+for step in plan:
+    if step["name"] not in status:
+        status[step["name"]] = "blocked"
+        report(step["name"], "blocked", -1, 0.0, "")
+
+failed = [name for name, s in status.items() if s not in ("ok", "skipped")]
+if failed:
+    print("Steps not completed: " + ", ".join(failed), file=sys.stderr)
+    sys.exit(1)
+"""
+
+
+def hash_steps(steps: List[PlanStep]) -> List[PlanStep]:
+    """
+    Give every step a hash of its own content and the hashes of the steps it
+    needs, so a change to a step changes the hash of everything downstream.
+    """
+    hashes: Dict[str, str] = {}
+    for step in steps:
+        digest = hashlib.sha256()
+        for part in [step.kind, step.script, step.content, step.remote_path, *sorted(hashes[n] for n in step.needs)]:
+            digest.update(part.encode("utf-8") + b"\0")
+        step.hash = hashes[step.name] = digest.hexdigest()
+    return steps
+
+
+def runner_script(steps: List[PlanStep], state_dir: str = STATE_DIR, max_workers: int = MAX_WORKERS) -> Tuple[str, str]:
+    """
+    The shell command running the plan and the plan to send on its stdin, steps
+    have to be in topological order. The command carries the plan's hash, so it
+    changes whenever the plan does.
+    """
+    plan = json.dumps([asdict(step) for step in hash_steps(steps)])
+    plan_hash = hashlib.sha256(plan.encode("utf-8")).hexdigest()
+    runner = base64.b64encode(dedent(RUNNER).strip().encode("utf-8")).decode("ascii")
+    return f"python3 -c \"$(echo {runner} | base64 -d)\" {plan_hash} {state_dir} {max_workers}", plan
+
+
+def parse_results(stdout: Optional[str]) -> Dict[str, StepResult]:
+    """
+    The result of every step reported in the runner's output.
+    """
+    results: Dict[str, StepResult] = {}
+    output: List[str] = []
+    for line in (stdout or "").splitlines():
+        if line.startswith("::step-begin "):
+            output = []
+        elif line.startswith("::step-end "):
+            name, status, code, seconds = line[len("::step-end "):].rsplit(" ", 3)
+            results[name] = StepResult(name, status, int(code), float(seconds), "\n".join(output))
+        else:
+            output.append(line)
+    return results
+
+
+if __name__ == "__main__":
+    # Print the command for a plan given as a JSON list of steps, or with
+    # --plan the input to send on its stdin.
+    with open(sys.argv[1]) as f:
+        command, plan = runner_script([PlanStep(**step) for step in json.load(f)])
+    sys.stdout.write(plan if sys.argv[2:] == ["--plan"] else command + "\n")
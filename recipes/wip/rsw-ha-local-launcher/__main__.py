@@ -1,6 +1,7 @@
 """An AWS Python Pulumi program"""
 
 import os
+from pathlib import Path
 from textwrap import dedent
 from typing import Dict, Optional
 import json
@@ -10,7 +11,7 @@ import pulumi
 from pulumi_aws import ec2, efs, rds, ssm, iam
 from pulumi_command import remote
 
-from src.helpers import BaseConfig, decode_key, get_key_pair
+from src.helpers import BaseConfig, content_hash, decode_key, get_key_pair
 
 
 def make_security_group(resource_id: str, tags: Dict):
@@ -75,6 +76,7 @@ def make_rsw_server(name: str, config: BaseConfig, tags: Dict):
         local_path="templates/justfile", 
         remote_path='justfile', 
         connection=connection, 
+        triggers=[content_hash(Path("templates/justfile").read_text())],
         opts=pulumi.ResourceOptions(depends_on=[server])
     )
 
@@ -8,6 +8,8 @@ from pulumi_aws import ec2
 
 
 import base64
+import hashlib
+import json
 
 @dataclass
 class BaseConfig:
@@ -37,4 +39,12 @@ def get_key_pair(config: pulumi.Config) -> ec2.KeyPair:
     key_name = config.get('keyName')
     public_key = config.get('publicKey')
     if key_name is None:
-        return ec2.KeyPair('key-rsw-ha', public_key=public_key)
\ No newline at end of file
+        return ec2.KeyPair('key-rsw-ha', public_key=public_key)
+
+
+def content_hash(content: str, **variables) -> str:
+    """
+    Hash content and its variables for a trigger
+    """
+    payload = json.dumps(variables, sort_keys=True, default=str) + "\n" + content
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
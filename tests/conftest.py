@@ -0,0 +1,20 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+TOOLS_DIR = Path(__file__).resolve().parent.parent / "tools"
+sys.path.insert(0, str(TOOLS_DIR))
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--update-baseline",
+        action="store_true",
+        help="Record the current measurements in tests/baseline.json instead of comparing against it.",
+    )
+
+
+@pytest.fixture
+def update_baseline(request) -> bool:
+    return request.config.getoption("--update-baseline")
@@ -0,0 +1,30 @@
+"""
+Run `tools/critical_path.py` the way CI does and read its output.
+"""
+
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pulumi")
+pytest.importorskip("pulumi_aws")
+pytest.importorskip("pulumi_command")
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def test_json_output_is_only_json():
+    # rsc-single-server prints while it is evaluated.
+    result = subprocess.run(
+        [sys.executable, "tools/critical_path.py", "--json", "recipes/rsc-single-server"],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    paths = json.loads(result.stdout)
+    assert [path["recipe"] for path in paths] == ["recipes/rsc-single-server"]
+    assert paths[0]["seconds"] == paths[0]["chain"][-1]["finish"]
@@ -0,0 +1,148 @@
+"""
+Resolve the Workbench daily build of rsw-single-server against a dailies index
+served by `http.server` on localhost.
+"""
+
+import importlib.util
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("requests")
+
+DAILIES_PATH = Path(__file__).resolve().parent.parent / "recipes/rsw-single-server/dailies.py"
+
+spec = importlib.util.spec_from_file_location("dailies", DAILIES_PATH)
+dailies = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(dailies)
+
+ETAG = '"index-1"'
+
+
+def index(version: str) -> dict:
+    filename = f"rstudio-workbench-{version}-amd64.deb"
+    build = {"link": f"https://example.com/{filename}", "filename": filename}
+    return {"products": {"workbench": {"platforms": {"bionic": build}}}}
+
+
+class DailiesServer(ThreadingHTTPServer):
+    daemon_threads = True
+    index = index("2022.07.0-daily-1")
+    delay = 0.0
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), DailiesHandler)
+        self.requests = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}/index.json"
+
+    def handle_error(self, request, client_address):
+        # A client that timed out has closed the connection before the reply.
+        pass
+
+
+class DailiesHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        time.sleep(self.server.delay)
+        if self.headers.get("If-None-Match") == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(self.server.index).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", ETAG)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = DailiesServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def cache_path(tmp_path):
+    return tmp_path / ".dailies-cache.json"
+
+
+def expire(cache_path: Path):
+    cache = json.loads(cache_path.read_text())
+    cache["fetched_at"] -= 2 * dailies.DEFAULT_TTL
+    cache_path.write_text(json.dumps(cache))
+
+
+def test_fetches_and_caches_the_index(server, cache_path):
+    link, filename = dailies.latest_workbench(url=server.url, cache_path=cache_path)
+    assert filename == "rstudio-workbench-2022.07.0-daily-1-amd64.deb"
+    assert link == f"https://example.com/{filename}"
+    assert len(server.requests) == 1
+    assert json.loads(cache_path.read_text())["etag"] == ETAG
+
+
+def test_fresh_cache_makes_no_request(server, cache_path):
+    dailies.fetch_index(url=server.url, cache_path=cache_path)
+    server.index = index("2022.07.0-daily-2")
+    assert dailies.fetch_index(url=server.url, cache_path=cache_path) == index("2022.07.0-daily-1")
+    assert len(server.requests) == 1
+
+
+def test_stale_cache_is_revalidated(server, cache_path):
+    dailies.fetch_index(url=server.url, cache_path=cache_path)
+    expire(cache_path)
+    fetched_at = json.loads(cache_path.read_text())["fetched_at"]
+
+    assert dailies.fetch_index(url=server.url, cache_path=cache_path) == index("2022.07.0-daily-1")
+    assert server.requests[-1]["If-None-Match"] == ETAG
+    # The 304 renews the cache, the next call within the TTL stays local.
+    assert json.loads(cache_path.read_text())["fetched_at"] > fetched_at
+    dailies.fetch_index(url=server.url, cache_path=cache_path)
+    assert len(server.requests) == 2
+
+
+def test_timeout_falls_back_to_the_cache(server, cache_path, caplog):
+    dailies.fetch_index(url=server.url, cache_path=cache_path)
+    expire(cache_path)
+    server.delay = 1.0
+
+    started = time.monotonic()
+    assert dailies.fetch_index(url=server.url, cache_path=cache_path, timeout=0.2) == index("2022.07.0-daily-1")
+    assert time.monotonic() - started < 1.0
+    assert "using the cached one" in caplog.text
+
+
+def test_timeout_without_cache_fails(server, cache_path):
+    server.delay = 1.0
+    with pytest.raises(RuntimeError, match="Could not fetch the dailies index"):
+        dailies.fetch_index(url=server.url, cache_path=cache_path, timeout=0.2)
+
+
+def test_offline_never_opens_a_socket(server, cache_path, monkeypatch):
+    dailies.fetch_index(url=server.url, cache_path=cache_path)
+    expire(cache_path)
+
+    def connect(*args):
+        raise AssertionError("offline mode opened a connection")
+
+    monkeypatch.setattr(socket.socket, "connect", connect)
+    assert dailies.fetch_index(url=server.url, cache_path=cache_path, offline=True) == index("2022.07.0-daily-1")
+    with pytest.raises(RuntimeError, match="Offline mode needs a cached dailies index"):
+        dailies.fetch_index(url=server.url, cache_path=cache_path.with_name("missing.json"), offline=True)
+    assert len(server.requests) == 1
@@ -0,0 +1,99 @@
+"""
+Evaluate every recipe under Pulumi mocks and compare it against a baseline.
+
+For each recipe the suite records the number of resources, the depth of the
+dependency graph, the expected wall-clock time of `pulumi up` (see
+`tools/critical_path.py`), the time to evaluate the program and the peak
+Python memory while doing so. A recipe fails when any of them grows past the
+baseline in `tests/baseline.json` by more than its tolerance.
+
+After an intended change, record the new numbers with:
+
+    python -m pytest tests --update-baseline
+"""
+
+import json
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict
+
+import pytest
+
+pytest.importorskip("pulumi")
+pytest.importorskip("pulumi_aws")
+pytest.importorskip("pulumi_command")
+
+from critical_path import critical_path, load_durations  # noqa: E402
+from recipe_mocks import RECIPES, load_recipe  # noqa: E402
+
+
+BASELINE_PATH = Path(__file__).resolve().parent / "baseline.json"
+
+# How far each measurement may grow past the baseline, as a fraction of the
+# baseline plus an absolute allowance. Timings are noisy, the graph is not.
+TOLERANCES = {
+    "resources": (0.0, 0),
+    "depth": (0.0, 0),
+    "critical_path_seconds": (0.0, 0),
+    "eval_seconds": (0.5, 0.25),
+    "peak_memory_mb": (0.25, 2.0),
+}
+
+# Evaluations per recipe, the fastest one is kept.
+TIMING_RUNS = 3
+
+
+def measure(recipe: str) -> Dict:
+    graph = load_recipe(recipe)
+    eval_seconds = []
+    for _ in range(TIMING_RUNS):
+        start = time.perf_counter()
+        load_recipe(recipe)
+        eval_seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        load_recipe(recipe)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "resources": len(graph.resources),
+        "depth": graph.depth(),
+        "critical_path_seconds": critical_path(graph, load_durations()).seconds,
+        "eval_seconds": round(min(eval_seconds), 3),
+        "peak_memory_mb": round(peak / 2**20, 2),
+    }
+
+
+def load_baseline() -> Dict:
+    if not BASELINE_PATH.exists():
+        return {}
+    return json.loads(BASELINE_PATH.read_text())
+
+
+def save_baseline(recipe: str, measured: Dict) -> None:
+    baseline = load_baseline()
+    baseline[recipe] = measured
+    BASELINE_PATH.write_text(json.dumps(baseline, indent=2, sort_keys=True) + "\n")
+
+
+@pytest.mark.parametrize("recipe", RECIPES)
+def test_recipe_against_baseline(recipe: str, update_baseline: bool):
+    measured = measure(recipe)
+    if update_baseline:
+        save_baseline(recipe, measured)
+        return
+
+    baseline = load_baseline().get(recipe)
+    if baseline is None:
+        pytest.fail(f"No baseline for {recipe}, record one with --update-baseline")
+
+    regressions = []
+    for key, (relative, absolute) in TOLERANCES.items():
+        limit = baseline[key] * (1 + relative) + absolute
+        if measured[key] > limit:
+            regressions.append(f"{key}: {measured[key]} > {limit:.3f} (baseline {baseline[key]})")
+    assert not regressions, f"{recipe} regressed:\n" + "\n".join(regressions)
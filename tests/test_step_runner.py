@@ -0,0 +1,97 @@
+"""
+Run the rstudio-team step runner against a real shell.
+
+By default the plan runs locally with bash. Set `STEP_RUNNER_SSH` to an ssh
+destination (e.g. `-p 2222 root@localhost` for a local sshd container) to run
+it over ssh instead, the host needs python3.
+"""
+
+import importlib.util
+import os
+import shlex
+import subprocess
+from pathlib import Path
+
+import pytest
+
+RUNNER_PATH = Path(__file__).resolve().parent.parent / "recipes/wip/rstudio-team/src/runner.py"
+
+spec = importlib.util.spec_from_file_location("step_runner", RUNNER_PATH)
+runner = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(runner)
+
+
+@pytest.fixture
+def run_plan(tmp_path):
+    ssh = os.getenv("STEP_RUNNER_SSH")
+    state_dir = "/tmp/step-runner-test-" + tmp_path.name if ssh else str(tmp_path / "state")
+
+    def run(steps):
+        command, plan = runner.runner_script(steps, state_dir=state_dir)
+        args = ["ssh", *shlex.split(ssh), command] if ssh else ["bash", "-c", command]
+        result = subprocess.run(args, input=plan, capture_output=True, text=True)
+        return result.returncode, runner.parse_results(result.stdout)
+
+    return run
+
+
+def plan(b: str = "echo b", c: str = "echo c"):
+    return [
+        runner.PlanStep("a", "command", script="echo a"),
+        runner.PlanStep("b", "command", script=b, after=["a"], needs=["a"]),
+        runner.PlanStep("c", "command", script=c),
+        runner.PlanStep("d", "command", script="echo d", after=["b", "c"], needs=["b"]),
+    ]
+
+
+def test_reports_every_step(run_plan):
+    code, results = run_plan(plan())
+    assert code == 0
+    assert {name: r.status for name, r in results.items()} == {"a": "ok", "b": "ok", "c": "ok", "d": "ok"}
+    assert results["b"].output == "b"
+
+
+def test_failure_blocks_downstream_and_resumes(run_plan):
+    code, results = run_plan(plan(b="echo broken; exit 3"))
+    assert code == 1
+    assert (results["b"].status, results["b"].exit_code, results["b"].output) == ("failed", 3, "broken")
+    assert results["d"].status == "blocked"
+
+    code, results = run_plan(plan())
+    assert code == 0
+    assert {name: r.status for name, r in results.items()} == {"a": "skipped", "b": "ok", "c": "skipped", "d": "ok"}
+
+
+def test_change_reruns_only_steps_needing_it(run_plan):
+    run_plan(plan())
+    _, results = run_plan(plan(c="echo c2"))
+    # d comes after c but does not need it.
+    assert {name: r.status for name, r in results.items()} == {"a": "skipped", "b": "skipped", "c": "ok", "d": "skipped"}
+    _, results = run_plan(plan(b="echo b2", c="echo c2"))
+    assert {name: r.status for name, r in results.items()} == {"a": "skipped", "b": "ok", "c": "skipped", "d": "ok"}
+
+
+def test_copy_step(run_plan, tmp_path):
+    if os.getenv("STEP_RUNNER_SSH"):
+        pytest.skip("checks the copied file locally")
+    target = tmp_path / "copied.conf"
+    code, results = run_plan([
+        runner.PlanStep("copy", "copy", content="x=1\n", remote_path=str(target)),
+        runner.PlanStep("cat", "command", script=f"cat {target}", after=["copy"], needs=["copy"]),
+    ])
+    assert code == 0
+    assert results["cat"].output == "x=1"
+
+
+
+def test_scripts_stay_off_the_command_line():
+    command, plan = runner.runner_script([runner.PlanStep("license", "command", script="activate LICENSE-KEY")])
+    assert "LICENSE-KEY" not in command
+    assert "LICENSE-KEY" in plan
+
+
+def test_rejects_a_plan_that_does_not_match_the_command(tmp_path):
+    command, steps = runner.runner_script(plan(), state_dir=str(tmp_path / "state"))
+    result = subprocess.run(["bash", "-c", command], input=steps[:-1], capture_output=True, text=True)
+    assert result.returncode == 1
+    assert runner.parse_results(result.stdout) == {}
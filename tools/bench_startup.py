@@ -0,0 +1,126 @@
+"""
+Measure how long each recipe's Pulumi program takes to import and evaluate.
+
+The Pulumi language host pays this cost on every `preview`, `refresh` and `up`
+before any cloud call is made. Each run evaluates the recipe under mocks (see
+`recipe_mocks.py`) in a fresh interpreter, so module imports are never warm.
+The time to import pulumi itself is reported separately from the program,
+which covers the recipe's own imports and building its resource graph.
+
+Usage:
+
+    python tools/bench_startup.py                        # all recipes
+    python tools/bench_startup.py --repeat 10 recipes/rsw-ha
+    python tools/bench_startup.py --json --imports 10 recipes/rsw-single-server
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import Dict, List
+
+TOOLS_DIR = Path(__file__).resolve().parent
+
+
+def measure(recipe: str) -> Dict:
+    """
+    Evaluate the recipe once in this interpreter. Run by `run_once` in a child.
+    """
+    start = time.perf_counter()
+    from recipe_mocks import load_recipe
+    imported = time.perf_counter()
+    modules = set(sys.modules)
+    graph = load_recipe(recipe)
+    done = time.perf_counter()
+    return {
+        "pulumi_import": imported - start,
+        "program": done - imported,
+        "resources": len(graph.resources),
+        "modules": len(set(sys.modules) - modules),
+    }
+
+
+def run_once(recipe: str, import_time: bool = False) -> Dict:
+    command = [sys.executable]
+    if import_time:
+        command += ["-X", "importtime"]
+    command += [str(Path(__file__).resolve()), "--child", recipe]
+    result = subprocess.run(command, cwd=TOOLS_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Evaluating {recipe} failed:\n{result.stderr}")
+    run = json.loads(result.stdout.splitlines()[-1])
+    if import_time:
+        run["imports"] = slowest_imports(result.stderr)
+    return run
+
+
+def slowest_imports(report: str) -> List[Dict]:
+    """
+    Top-level imports from a `-X importtime` report with their cumulative time.
+    """
+    imports = []
+    for line in report.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented, only keep the ones done directly.
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            imports.append({"module": name.strip(), "seconds": int(cumulative) / 1e6})
+    return sorted(imports, key=lambda i: i["seconds"], reverse=True)
+
+
+def bench(recipe: str, repeat: int, imports: int) -> Dict:
+    runs = [run_once(recipe) for _ in range(repeat)]
+    result = {
+        "recipe": recipe,
+        "runs": repeat,
+        "resources": runs[0]["resources"],
+        "modules": runs[0]["modules"],
+        "pulumi_import": statistics.median(r["pulumi_import"] for r in runs),
+        "program": statistics.median(r["program"] for r in runs),
+        "program_min": min(r["program"] for r in runs),
+    }
+    if imports:
+        result["imports"] = run_once(recipe, import_time=True)["imports"][:imports]
+    return result
+
+
+def print_report(result: Dict) -> None:
+    print(
+        f"{result['recipe']}: program {result['program']:.3f}s"
+        f" (min {result['program_min']:.3f}s, pulumi import {result['pulumi_import']:.3f}s,"
+        f" {result['resources']} resources, {result['modules']} modules, {result['runs']} runs)"
+    )
+    for item in result.get("imports", []):
+        print(f"  {item['seconds']:>7.3f}s  {item['module']}")
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recipes", nargs="*", help="Recipe directories relative to the repo root.")
+    parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters per recipe, the median is reported.")
+    parser.add_argument("--imports", type=int, default=0, help="Also list the N slowest top-level imports.")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON.")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        print(json.dumps(measure(args.child)))
+        return 0
+
+    from recipe_mocks import RECIPES
+    results = [bench(recipe.rstrip("/"), args.repeat, args.imports) for recipe in args.recipes or RECIPES]
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            print_report(result)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
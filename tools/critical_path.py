@@ -0,0 +1,129 @@
+"""
+Report the longest provisioning chain of a recipe without touching AWS.
+
+Each recipe is evaluated under Pulumi mocks (see `recipe_mocks.py`). Every
+resource gets an expected duration from `step_durations.json`: the first
+pattern under "steps" that matches the resource name wins, otherwise the
+duration for its type under "types", otherwise "default". Resources that do
+not depend on each other are assumed to run in parallel, so the expected
+wall-clock time of `pulumi up` is the heaviest path through the graph.
+
+Usage:
+
+    python tools/critical_path.py recipes/rsw-ha recipes/wip/rstudio-team
+    python tools/critical_path.py --json --max-seconds 1500 recipes/rsw-ha
+"""
+
+import argparse
+import fnmatch
+import json
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List
+
+from recipe_mocks import RECIPES, RecipeGraph, load_recipe
+
+
+DURATIONS_PATH = Path(__file__).resolve().parent / "step_durations.json"
+
+
+@dataclass
+class CriticalPath:
+    recipe: str
+    seconds: float
+    chain: List[Dict]
+
+
+def load_durations(path: Path = DURATIONS_PATH) -> Dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def duration(resource_type: str, name: str, durations: Dict) -> float:
+    for pattern, seconds in durations.get("steps", {}).items():
+        if fnmatch.fnmatchcase(name, pattern):
+            return seconds
+    return durations.get("types", {}).get(resource_type, durations.get("default", 0))
+
+
+def critical_path(graph: RecipeGraph, durations: Dict) -> CriticalPath:
+    """
+    Find the path through the dependency graph with the largest total duration.
+    """
+    edges = graph.edges()
+    finish: Dict[str, float] = {}
+    previous: Dict[str, str] = {}
+
+    def visit(urn: str, stack: frozenset) -> float:
+        if urn in finish:
+            return finish[urn]
+        if urn in stack:
+            raise ValueError(f"Dependency cycle through {urn}")
+        start = 0.0
+        for upstream in edges[urn]:
+            upstream_finish = visit(upstream, stack | {urn})
+            if urn not in previous or upstream_finish > start:
+                start, previous[urn] = upstream_finish, upstream
+        record = graph.resources[urn]
+        finish[urn] = start + duration(record.type, record.name, durations)
+        return finish[urn]
+
+    for urn in edges:
+        visit(urn, frozenset())
+
+    if not finish:
+        return CriticalPath(graph.recipe, 0, [])
+
+    urn = max(finish, key=finish.get)
+    chain = []
+    while urn is not None:
+        record = graph.resources[urn]
+        chain.append({
+            "type": record.type,
+            "name": record.name,
+            "seconds": duration(record.type, record.name, durations),
+            "finish": finish[urn],
+        })
+        urn = previous.get(urn)
+    chain.reverse()
+    return CriticalPath(graph.recipe, chain[-1]["finish"], chain)
+
+
+def format_seconds(seconds: float) -> str:
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return f"{minutes}m {seconds:02d}s"
+
+
+def print_report(path: CriticalPath) -> None:
+    print(f"{path.recipe}: expected wall-clock {format_seconds(path.seconds)}")
+    for step in path.chain:
+        print(f"  {format_seconds(step['finish']):>8}  +{step['seconds']:>4}s  {step['type']:<40} {step['name']}")
+    print()
+
+
+def main(argv: List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recipes", nargs="*", default=RECIPES, help="Recipe directories relative to the repo root.")
+    parser.add_argument("--durations", type=Path, default=DURATIONS_PATH, help="Per-step duration table.")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON.")
+    parser.add_argument("--max-seconds", type=float, help="Exit with an error if any recipe is expected to take longer.")
+    args = parser.parse_args(argv)
+
+    durations = load_durations(args.durations)
+    paths = [critical_path(load_recipe(recipe.rstrip("/")), durations) for recipe in args.recipes]
+
+    if args.json:
+        print(json.dumps([path.__dict__ for path in paths], indent=2))
+    else:
+        for path in paths:
+            print_report(path)
+
+    too_slow = [p for p in paths if args.max_seconds is not None and p.seconds > args.max_seconds]
+    for path in too_slow:
+        print(f"{path.recipe} is expected to take {format_seconds(path.seconds)}, over the limit", file=sys.stderr)
+    return 1 if too_slow else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())